@@ -5,6 +5,7 @@ from . import database
 from . import objects
 from . import helpers
 from . import streams
+from . import schemas
 from . import officer
 from . import cache
 from . import mail
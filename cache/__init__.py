@@ -1,4 +1,5 @@
 
+from . import serialization
 from . import leaderboards
 from . import usercount
 from . import status
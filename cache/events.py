@@ -1,23 +1,119 @@
 
-from typing import Dict, Generator, Callable
-from redis import Redis
+from __future__ import annotations
 
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Generator, Callable, Tuple, Set
+from collections import deque
+from redis import Redis, ResponseError
+from functools import partial
+
+from .serialization import Serializer, BinarySerializer
+
+import threading
 import logging
+import socket
+import time
+import os
+
+class EventStats:
+    """Counters for the callbacks of a single event"""
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.running = 0
+        self.completions = 0
+        self.failures = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    @property
+    def average_latency(self) -> float:
+        finished = self.completions + self.failures
+        return self.total_latency / finished if finished else 0.0
+
+    def queued(self) -> None:
+        with self.lock:
+            self.pending += 1
+
+    def started(self) -> None:
+        with self.lock:
+            self.pending -= 1
+            self.running += 1
+
+    def completed(self, latency: float) -> None:
+        with self.lock:
+            self.running -= 1
+            self.completions += 1
+            self.add_latency(latency)
+
+    def failed(self, latency: float) -> None:
+        with self.lock:
+            self.running -= 1
+            self.failures += 1
+            self.add_latency(latency)
+
+    def add_latency(self, latency: float) -> None:
+        self.total_latency += latency
+        self.max_latency = max(self.max_latency, latency)
+
+    def as_dict(self) -> dict:
+        return {
+            'pending': self.pending,
+            'running': self.running,
+            'completions': self.completions,
+            'failures': self.failures,
+            'average_latency': self.average_latency,
+            'max_latency': self.max_latency
+        }
 
 class EventQueue:
-    def __init__(self, name: str, connection: Redis) -> None:
+    def __init__(
+        self,
+        name: str,
+        connection: Redis,
+        serializer: Serializer | None = None,
+        durable: bool = False,
+        group: str = 'workers',
+        consumer: str | None = None,
+        max_length: int = 100000,
+        claim_idle_time: int = 60000,
+        block: int = 5000,
+        batch_size: int = 16,
+        max_deliveries: int = 5
+    ) -> None:
+        # Events are published in the legacy format by default, so that listeners
+        # which were not upgraded yet can still read them. Pass a
+        # `BinarySerializer()` once every listener can decode the binary format.
+        self.serializer = serializer or BinarySerializer(encode_legacy=True)
         self.redis = connection
         self.name = name
 
         self.events: Dict[str, Callable] = {}
+        self.stats: Dict[str, EventStats] = {}
         self.logger = logging.getLogger(self.name)
 
         self.channel = self.redis.pubsub()
 
+        # Settings for the redis stream backend
+        self.durable = durable
+        self.group = group
+        self.consumer = consumer or f'{socket.gethostname()}:{os.getpid()}'
+        self.max_length = max_length
+        self.claim_idle_time = claim_idle_time
+        self.block = block
+        self.batch_size = batch_size
+        self.max_deliveries = max_deliveries
+        self.claim_cursor = '0-0'
+
+        # Ids of stream events that are currently being processed by this consumer
+        self.in_flight: Set[bytes] = set()
+
     def register(self, event_name: str):
         """Register an event"""
         def wrapper(callback: Callable):
             self.events[event_name] = callback
+            self.stats[event_name] = EventStats()
             self.logger.debug(
                 f'Registered new event: "{event_name}"'
             )
@@ -26,27 +122,278 @@ class EventQueue:
 
     def submit(self, event: str, *args, **kwargs):
         """Push an event to the queue"""
-        self.redis.publish(self.name, str((event, args, kwargs)))
+        data = self.serializer.encode(event, args, kwargs)
+
+        if self.durable:
+            self.redis.xadd(
+                self.name,
+                {'data': data},
+                maxlen=self.max_length,
+                approximate=True
+            )
+            self.logger.debug(f'Submitted event "{event}" to stream')
+            return
+
+        self.redis.publish(self.name, data)
         self.logger.debug(f'Submitted event "{event}" to pubsub channel')
 
     def listen(self) -> Generator:
         """Listen for events from the queue"""
+        for name, callback, args, kwargs, ack in self.receive():
+            yield callback, args, kwargs
+            ack()
+
+    def dispatch(
+        self,
+        workers: int = 8,
+        limits: Dict[str, int] | None = None,
+        max_pending: int | None = None
+    ) -> None:
+        """Listen for events and run their callbacks on a bounded thread pool.
+
+        `limits` can be used to restrict how many callbacks of one event can run
+        at the same time. Events over their limit are deferred until a callback
+        of the same event finishes, so that other events are not held up. The
+        listener stops receiving new events while `max_pending` events are
+        waiting to be completed. In durable mode, events only get acknowledged
+        after their callback has finished.
+        """
+        limits = limits or {}
+        max_pending = max_pending or workers * 2
+        pending = threading.BoundedSemaphore(max_pending)
+        lock = threading.Lock()
+        running: Dict[str, int] = {name: 0 for name in limits}
+        deferred: Dict[str, deque] = {name: deque() for name in limits}
+
+        with ThreadPoolExecutor(workers, thread_name_prefix=self.name) as pool:
+            def submit(event: tuple) -> None:
+                pool.submit(self.run, *event).add_done_callback(
+                    lambda _: finished(event[0])
+                )
+
+            def finished(name: str) -> None:
+                pending.release()
+
+                if name not in limits:
+                    return
+
+                with lock:
+                    if not deferred[name]:
+                        running[name] -= 1
+                        return
+
+                    event = deferred[name].popleft()
+
+                submit(event)
+
+            for name, callback, args, kwargs, ack in self.receive():
+                pending.acquire()
+                self.stats[name].queued()
+                event = (name, callback, args, kwargs, ack)
+
+                if name in limits:
+                    with lock:
+                        if running[name] >= limits[name]:
+                            deferred[name].append(event)
+                            continue
+
+                        running[name] += 1
+
+                submit(event)
+
+            # Wait for deferred events, before the pool gets shut down
+            for _ in range(max_pending):
+                pending.acquire()
+
+    def run(
+        self,
+        name: str,
+        callback: Callable,
+        args: tuple,
+        kwargs: dict,
+        ack: Callable
+    ) -> None:
+        start = time.perf_counter()
+        stats = self.stats[name]
+        stats.started()
+
+        try:
+            callback(*args, **kwargs)
+            stats.completed(time.perf_counter() - start)
+        except Exception as e:
+            stats.failed(time.perf_counter() - start)
+            self.logger.error(
+                f'Failed to run callback for "{name}": {e}',
+                exc_info=e
+            )
+        finally:
+            ack()
+
+    def receive(self) -> Generator:
+        """Receive events with a callback to acknowledge them"""
+        if self.durable:
+            yield from self.receive_stream()
+            return
+
         self.channel.subscribe(self.name)
         self.logger.info('Listening to pubsub channel...')
 
         for message in self.channel.listen():
-            try:
-                if message['data'] == 1: continue
-                name, args, kwargs = eval(message['data'])
-                self.logger.debug(
-                    f'Got event for "{name}" with {args} and {kwargs}'
-                )
-                yield self.events[name], args, kwargs
-            except KeyError:
-                self.logger.warning(
-                    f'No callback found for "{name}"'
-                )
-            except Exception as e:
-                self.logger.warning(
-                    f'Failed to evaluate task: {e}'
-                )
+            if message['data'] == 1:
+                continue
+
+            if not (event := self.resolve(message['data'])):
+                continue
+
+            yield *event, lambda: None
+
+    def receive_stream(self) -> Generator:
+        """Receive events from the stream as part of the consumer group.
+
+        Events should be acknowledged once they were processed, otherwise they
+        will be reclaimed by other consumers after `claim_idle_time` milliseconds.
+        """
+        self.create_group()
+        self.logger.info(
+            f'Listening to stream as "{self.consumer}" in group "{self.group}"...'
+        )
+
+        while True:
+            for message_id, fields in self.reclaim() + self.read():
+                ack = partial(self.acknowledge, message_id)
+
+                if not (event := self.resolve(fields.get(b'data'))):
+                    ack()
+                    continue
+
+                self.in_flight.add(message_id)
+                yield *event, ack
+
+    def acknowledge(self, message_id: bytes) -> None:
+        self.redis.xack(self.name, self.group, message_id)
+        self.in_flight.discard(message_id)
+
+    def queue_depth(self) -> int:
+        """Get the amount of events, that are waiting to be processed by the pool"""
+        return sum(stats.pending for stats in self.stats.values())
+
+    def create_group(self) -> None:
+        try:
+            self.redis.xgroup_create(
+                self.name,
+                self.group,
+                id='0',
+                mkstream=True
+            )
+        except ResponseError as e:
+            if 'BUSYGROUP' not in str(e):
+                raise
+
+    def read(self) -> list:
+        response = self.redis.xreadgroup(
+            self.group,
+            self.consumer,
+            {self.name: '>'},
+            count=self.batch_size,
+            block=self.block
+        )
+
+        if not response:
+            return []
+
+        _, messages = response[0]
+        return messages
+
+    def reclaim(self) -> list:
+        """Claim pending events of consumers, that have been idle for too long.
+
+        The pending entries are scanned with a cursor, so that events further back
+        will be reached as well. Events that were delivered more than `max_deliveries`
+        times are moved to the "{name}:dead" stream, instead of being retried forever.
+        """
+        response = self.redis.xautoclaim(
+            self.name,
+            self.group,
+            self.consumer,
+            min_idle_time=self.claim_idle_time,
+            start_id=self.claim_cursor,
+            count=self.batch_size
+        )
+
+        self.claim_cursor = response[0]
+        claimed = []
+
+        for message_id, fields in response[1]:
+            if message_id in self.in_flight:
+                # Event is still being processed by this consumer,
+                # claiming it has already reset its idle time
+                continue
+
+            if fields is None:
+                # Event was already trimmed from the stream
+                self.redis.xack(self.name, self.group, message_id)
+                continue
+
+            claimed.append((message_id, fields))
+
+        if not claimed:
+            return []
+
+        pipe = self.redis.pipeline(transaction=False)
+
+        for message_id, _ in claimed:
+            pipe.xpending_range(
+                self.name, self.group,
+                min=message_id, max=message_id,
+                count=1
+            )
+
+        messages = []
+
+        for (message_id, fields), pending in zip(claimed, pipe.execute()):
+            deliveries = pending[0]['times_delivered'] if pending else 0
+
+            if deliveries > self.max_deliveries:
+                self.dead_letter(message_id, fields, deliveries)
+                continue
+
+            messages.append((message_id, fields))
+
+        if messages:
+            self.logger.info(f'Reclaimed {len(messages)} pending events')
+
+        return messages
+
+    def dead_letter(self, message_id: bytes, fields: dict, deliveries: int) -> None:
+        """Move an event that keeps failing to the dead letter stream"""
+        pipe = self.redis.pipeline()
+        pipe.xadd(
+            f'{self.name}:dead',
+            {**fields, 'id': message_id, 'deliveries': deliveries},
+            maxlen=self.max_length,
+            approximate=True
+        )
+        pipe.xack(self.name, self.group, message_id)
+        pipe.execute()
+
+        self.logger.warning(
+            f'Moved event "{message_id.decode()}" to dead letter stream after {deliveries} deliveries'
+        )
+
+    def resolve(self, data: bytes) -> Tuple[str, Callable, tuple, dict] | None:
+        name = None
+
+        try:
+            name, args, kwargs = self.serializer.decode(data)
+            self.logger.debug(
+                f'Got event for "{name}" with {args} and {kwargs}'
+            )
+            return name, self.events[name], args, kwargs
+        except KeyError:
+            self.logger.warning(
+                f'No callback found for "{name}"'
+            )
+        except Exception as e:
+            self.logger.warning(
+                f'Failed to evaluate task: {e}'
+            )
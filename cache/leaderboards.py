@@ -2,70 +2,118 @@
 from __future__ import annotations
 
 from ..constants import COUNTRIES as countries
+from ..database.repositories import stats as stats_repository
+from ..database.repositories.wrapper import session_wrapper
 from ..database.repositories import users
 from ..database.objects import DBStats
 
-from typing import Tuple, List
+from dataclasses import dataclass
+from typing import Generator, Iterable, Tuple, List, Dict
+from redis.commands.core import Script
+from redis.client import Pipeline
+from sqlalchemy.orm import Session
 
 import app
 
-def update(stats: DBStats, country: str) -> None:
-    """Update ppv1, ppv2, country and score ranks"""
-    # Performance
-    app.session.redis.zadd(
-        f'bancho:performance:{stats.mode}',
-        {stats.user_id: float(stats.pp)}
-    )
-
-    app.session.redis.zadd(
-        f'bancho:performance:{stats.mode}:{country.lower()}',
-        {stats.user_id: float(stats.pp)}
-    )
-
-    # Ranked Score
-    app.session.redis.zadd(
-        f'bancho:rscore:{stats.mode}',
-        {stats.user_id: stats.rscore}
-    )
-
-    app.session.redis.zadd(
-        f'bancho:rscore:{stats.mode}:{country.lower()}',
-        {stats.user_id: stats.rscore}
-    )
-
-    # Total Score
-    app.session.redis.zadd(
-        f'bancho:tscore:{stats.mode}',
-        {stats.user_id: stats.tscore}
-    )
-
-    app.session.redis.zadd(
-        f'bancho:tscore:{stats.mode}:{country.lower()}',
-        {stats.user_id: stats.tscore}
-    )
-
-    # PPV1
-    app.session.redis.zadd(
-        f'bancho:ppv1:{stats.mode}',
-        {stats.user_id: stats.ppv1}
-    )
+LEADERBOARD_TYPES = (
+    'performance',
+    'rscore',
+    'tscore',
+    'ppv1',
+    'acc',
+    'clears',
+    'ppvn',
+    'pprx',
+    'ppap'
+)
+
+# Leaderboards that are summed up into the country rankings
+COUNTRY_TOTAL_TYPES = (
+    'performance',
+    'rscore',
+    'tscore'
+)
+
+# KEYS: country performance, rscore & tscore leaderboards, country totals
+# ARGV: user id, country, performance, rscore, tscore
+COUNTRY_UPDATE_SCRIPT = """
+local previous_pp = tonumber(redis.call('ZSCORE', KEYS[1], ARGV[1]) or 0)
+local current_pp = tonumber(ARGV[3])
+
+for index, name in ipairs({'performance', 'rscore', 'tscore'}) do
+    local previous = tonumber(redis.call('ZSCORE', KEYS[index], ARGV[1]) or 0)
+    local current = tonumber(ARGV[index + 2])
+    redis.call('HINCRBYFLOAT', KEYS[4], ARGV[2] .. ':' .. name, current - previous)
+end
+
+if previous_pp < 1 and current_pp >= 1 then
+    redis.call('HINCRBY', KEYS[4], ARGV[2] .. ':users', 1)
+elseif previous_pp >= 1 and current_pp < 1 then
+    redis.call('HINCRBY', KEYS[4], ARGV[2] .. ':users', -1)
+end
+"""
+
+# KEYS: country performance, rscore & tscore leaderboards, country totals
+# ARGV: user id, country
+COUNTRY_REMOVE_SCRIPT = """
+local previous_pp = redis.call('ZSCORE', KEYS[1], ARGV[1])
+
+for index, name in ipairs({'performance', 'rscore', 'tscore'}) do
+    local previous = redis.call('ZSCORE', KEYS[index], ARGV[1])
+
+    if previous then
+        redis.call('HINCRBYFLOAT', KEYS[4], ARGV[2] .. ':' .. name, -tonumber(previous))
+    end
+end
+
+if previous_pp and tonumber(previous_pp) >= 1 then
+    redis.call('HINCRBY', KEYS[4], ARGV[2] .. ':users', -1)
+end
+"""
+
+# KEYS: country performance, rscore & tscore leaderboards, country totals
+# ARGV: country
+COUNTRY_TOTALS_SCRIPT = """
+for index, name in ipairs({'performance', 'rscore', 'tscore'}) do
+    local values = redis.call('ZRANGE', KEYS[index], 0, -1, 'WITHSCORES')
+    local total = 0
+
+    for i = 2, #values, 2 do
+        total = total + tonumber(values[i])
+    end
+
+    redis.call('HSET', KEYS[4], ARGV[1] .. ':' .. name, string.format('%.17g', total))
+end
+
+redis.call('HSET', KEYS[4], ARGV[1] .. ':users', redis.call('ZCOUNT', KEYS[1], 1, '+inf'))
+"""
+
+scripts: Dict[str, Script] = {}
+
+def queue_script(
+    pipe: Pipeline,
+    source: str,
+    keys: List[str],
+    args: list,
+    inline: bool = True
+) -> None:
+    """Queue a lua script onto a pipeline.
 
-    app.session.redis.zadd(
-        f'bancho:ppv1:{stats.mode}:{country.lower()}',
-        {stats.user_id: stats.ppv1}
-    )
+    Inline scripts are sent with EVAL, which avoids the extra round trip that
+    redis-py makes to check for loaded scripts. Large batches should use
+    registered scripts instead, which are only checked once per execution.
+    """
+    if inline:
+        pipe.eval(source, len(keys), *keys, *args)
+        return
 
-    # Accuracy
-    app.session.redis.zadd(
-        f'bancho:acc:{stats.mode}',
-        {stats.user_id: stats.acc}
-    )
+    if source not in scripts:
+        scripts[source] = app.session.redis.register_script(source)
 
-    app.session.redis.zadd(
-        f'bancho:acc:{stats.mode}:{country.lower()}',
-        {stats.user_id: stats.acc}
-    )
+    scripts[source](keys=keys, args=args, client=pipe)
 
+def leaderboard_values(stats: DBStats) -> Dict[str, float]:
+    """Get the score of every leaderboard type for the given stats"""
     clears = sum([
         stats.xh_count,
         stats.x_count,
@@ -77,203 +125,302 @@ def update(stats: DBStats, country: str) -> None:
         stats.d_count
     ])
 
-    # Clears
-    app.session.redis.zadd(
-        f'bancho:clears:{stats.mode}',
-        {stats.user_id: clears}
-    )
+    return {
+        'performance': float(stats.pp),
+        'rscore': stats.rscore,
+        'tscore': stats.tscore,
+        'ppv1': stats.ppv1,
+        'acc': stats.acc,
+        'clears': clears,
+        'ppvn': stats.pp_vn,
+        'pprx': stats.pp_rx,
+        'ppap': stats.pp_ap
+    }
+
+def queue_update(
+    pipe: Pipeline,
+    stats: DBStats,
+    country: str,
+    prefix: str = 'bancho',
+    inline: bool = True
+) -> None:
+    """Queue all leaderboard updates for the given stats onto a pipeline"""
+    values = leaderboard_values(stats)
+
+    # This needs to run before the country leaderboards get updated,
+    # since the country totals are calculated from the previous scores
+    queue_script(
+        pipe,
+        COUNTRY_UPDATE_SCRIPT,
+        keys=[
+            *(
+                f'{prefix}:{type}:{stats.mode}:{country.lower()}'
+                for type in COUNTRY_TOTAL_TYPES
+            ),
+            f'{prefix}:countries:{stats.mode}'
+        ],
+        args=[
+            stats.user_id,
+            country.lower(),
+            *(values[type] for type in COUNTRY_TOTAL_TYPES)
+        ],
+        inline=inline
+    )
+
+    for type, value in values.items():
+        pipe.zadd(
+            f'{prefix}:{type}:{stats.mode}',
+            {stats.user_id: value}
+        )
 
-    app.session.redis.zadd(
-        f'bancho:clears:{stats.mode}:{country.lower()}',
-        {stats.user_id: clears}
-    )
+        pipe.zadd(
+            f'{prefix}:{type}:{stats.mode}:{country.lower()}',
+            {stats.user_id: value}
+        )
 
-    # PP VN
-    app.session.redis.zadd(
-        f'bancho:ppvn:{stats.mode}',
-        {stats.user_id: stats.pp_vn}
+def queue_country_removal(
+    pipe: Pipeline,
+    user_id: int,
+    mode: int,
+    country: str
+) -> None:
+    """Queue the removal of a player from the country totals onto a pipeline"""
+    queue_script(
+        pipe,
+        COUNTRY_REMOVE_SCRIPT,
+        keys=[
+            *(
+                f'bancho:{type}:{mode}:{country.lower()}'
+                for type in COUNTRY_TOTAL_TYPES
+            ),
+            f'bancho:countries:{mode}'
+        ],
+        args=[user_id, country.lower()]
     )
 
-    app.session.redis.zadd(
-        f'bancho:ppvn:{stats.mode}:{country.lower()}',
-        {stats.user_id: stats.pp_vn}
-    )
+def update(stats: DBStats, country: str) -> None:
+    """Update ppv1, ppv2, country and score ranks"""
+    pipe = app.session.redis.pipeline()
+    queue_update(pipe, stats, country)
+    pipe.execute()
+
+def update_many(
+    entries: Iterable[Tuple[DBStats, str]],
+    batch_size: int = 1000,
+    prefix: str = 'bancho'
+) -> int:
+    """Update the leaderboards for multiple players, using one round trip per batch
 
-    # PP RX
-    app.session.redis.zadd(
-        f'bancho:pprx:{stats.mode}',
-        {stats.user_id: stats.pp_rx}
-    )
+    `returns`: The amount of updated stats
+    """
+    pipe = app.session.redis.pipeline(transaction=False)
+    count = 0
 
-    app.session.redis.zadd(
-        f'bancho:pprx:{stats.mode}:{country.lower()}',
-        {stats.user_id: stats.pp_rx}
-    )
+    for stats, country in entries:
+        queue_update(pipe, stats, country, prefix, inline=False)
+        count += 1
+
+        if count % batch_size == 0:
+            pipe.execute()
 
-    # PP AP
-    app.session.redis.zadd(
-        f'bancho:ppap:{stats.mode}',
-        {stats.user_id: stats.pp_ap}
+    pipe.execute()
+    return count
+
+@session_wrapper
+def rebuild(
+    mode: int | None = None,
+    batch_size: int = 5000,
+    session: Session = ...
+) -> int:
+    """Rebuild the leaderboards from the database.
+
+    All sorted sets get built inside of shadow keys first, and are then
+    swapped in with a single transaction, so that readers will never see
+    a partially built leaderboard.
+
+    `returns`: The amount of inserted stats
+    """
+    modes = list(range(4)) if mode is None else [mode]
+    shadow_prefix = 'bancho:rebuild'
+
+    suffixes = {
+        f'{m}{f":{c.lower()}" if c else ""}'
+        for m in modes
+        for c in [None, *countries.keys()]
+    }
+
+    # Remove leftovers from a previous rebuild that failed
+    app.session.redis.delete(
+        *(
+            f'{shadow_prefix}:{type}:{suffix}'
+            for suffix in suffixes
+            for type in LEADERBOARD_TYPES
+        ),
+        *(
+            f'{shadow_prefix}:countries:{m}'
+            for m in modes
+        )
     )
 
-    app.session.redis.zadd(
-        f'bancho:ppap:{stats.mode}:{country.lower()}',
-        {stats.user_id: stats.pp_ap}
+    populated = set()
+
+    def entries() -> Generator[Tuple[DBStats, str], None, None]:
+        for stats, country in stats_repository.fetch_leaderboard_entries(
+            mode, batch_size,
+            session=session
+        ):
+            populated.add(f'{stats.mode}')
+            populated.add(f'{stats.mode}:{country.lower()}')
+            yield stats, country
+
+    count = update_many(
+        entries(),
+        batch_size,
+        shadow_prefix
     )
 
-def remove_country(
-    user_id: int,
-    country: str
-) -> None:
-    """Remove player from country leaderboards"""
-    for mode in range(4):
-        app.session.redis.zrem(
-            f'bancho:performance:{mode}:{country.lower()}',
-            user_id
-        )
+    # Swap in the new leaderboards, and remove the ones that are now empty
+    pipe = app.session.redis.pipeline(transaction=True)
 
-        app.session.redis.zrem(
-            f'bancho:rscore:{mode}:{country.lower()}',
-            user_id
-        )
+    for suffix in suffixes | populated:
+        for type in LEADERBOARD_TYPES:
+            if suffix not in populated:
+                pipe.delete(f'bancho:{type}:{suffix}')
+                continue
 
-        app.session.redis.zrem(
-            f'bancho:tscore:{mode}:{country.lower()}',
-            user_id
-        )
+            pipe.rename(
+                f'{shadow_prefix}:{type}:{suffix}',
+                f'bancho:{type}:{suffix}'
+            )
 
-        app.session.redis.zrem(
-            f'bancho:ppv1:{mode}:{country.lower()}',
-            user_id
-        )
+    for m in modes:
+        if f'{m}' not in populated:
+            pipe.delete(f'bancho:countries:{m}')
+            continue
 
-        app.session.redis.zrem(
-            f'bancho:acc:{mode}:{country.lower()}',
-            user_id
+        pipe.rename(
+            f'{shadow_prefix}:countries:{m}',
+            f'bancho:countries:{m}'
         )
 
-        app.session.redis.zrem(
-            f'bancho:ppvn:{mode}:{country.lower()}',
-            user_id
-        )
+    for m in modes:
+        pipe.set(f'bancho:countries:{m}:indexed', 1)
 
-        app.session.redis.zrem(
-            f'bancho:pprx:{mode}:{country.lower()}',
-            user_id
-        )
+    pipe.execute()
+    return count
 
-        app.session.redis.zrem(
-            f'bancho:ppap:{mode}:{country.lower()}',
-            user_id
-        )
+def remove_country(
+    user_id: int,
+    country: str
+) -> None:
+    """Remove player from country leaderboards"""
+    pipe = app.session.redis.pipeline()
+
+    for mode in range(4):
+        queue_country_removal(pipe, user_id, mode, country)
+
+        for type in LEADERBOARD_TYPES:
+            pipe.zrem(
+                f'bancho:{type}:{mode}:{country.lower()}',
+                user_id
+            )
+
+    pipe.execute()
 
 def remove(
     user_id: int,
     country: str
 ) -> None:
     """Remove player from leaderboards"""
+    pipe = app.session.redis.pipeline()
+
     for mode in range(4):
-        app.session.redis.zrem(
-            f'bancho:performance:{mode}',
-            user_id
-        )
+        queue_country_removal(pipe, user_id, mode, country)
 
-        app.session.redis.zrem(
-            f'bancho:performance:{mode}:{country.lower()}',
-            user_id
-        )
+        for type in LEADERBOARD_TYPES:
+            pipe.zrem(
+                f'bancho:{type}:{mode}',
+                user_id
+            )
 
-        app.session.redis.zrem(
-            f'bancho:rscore:{mode}',
-            user_id
-        )
+            pipe.zrem(
+                f'bancho:{type}:{mode}:{country.lower()}',
+                user_id
+            )
 
-        app.session.redis.zrem(
-            f'bancho:rscore:{mode}:{country.lower()}',
-            user_id
-        )
+    pipe.execute()
 
-        app.session.redis.zrem(
-            f'bancho:tscore:{mode}',
-            user_id
-        )
+@dataclass(slots=True)
+class Ranking:
+    rank: int = 0
+    score: float = 0
+    country_rank: int = 0
 
-        app.session.redis.zrem(
-            f'bancho:tscore:{mode}:{country.lower()}',
-            user_id
-        )
+def ranks_for(
+    user_ids: Iterable[int],
+    mode: int,
+    types: Iterable[str] = LEADERBOARD_TYPES,
+    country: str | None = None
+) -> Dict[int, Dict[str, Ranking]]:
+    """Get the ranks and scores of multiple players inside a single round trip.
+    Country ranks will only be resolved, if a country was specified.
 
-        app.session.redis.zrem(
-            f'bancho:ppv1:{mode}',
-            user_id
-        )
+    `returns`: Dict[player_id, Dict[type, Ranking]]
+    """
+    user_ids = list(user_ids)
+    types = list(types)
 
-        app.session.redis.zrem(
-            f'bancho:ppv1:{mode}:{country.lower()}',
-            user_id
-        )
+    pipe = app.session.redis.pipeline(transaction=False)
 
-        app.session.redis.zrem(
-            f'bancho:acc:{mode}',
-            user_id
-        )
+    for user_id in user_ids:
+        for type in types:
+            pipe.zrevrank(f'bancho:{type}:{mode}', user_id)
+            pipe.zscore(f'bancho:{type}:{mode}', user_id)
 
-        app.session.redis.zrem(
-            f'bancho:acc:{mode}:{country.lower()}',
-            user_id
-        )
+            if country:
+                pipe.zrevrank(f'bancho:{type}:{mode}:{country.lower()}', user_id)
 
-        app.session.redis.zrem(
-            f'bancho:ppvn:{mode}',
-            user_id
-        )
+    results = iter(pipe.execute())
+    rankings = {}
 
-        app.session.redis.zrem(
-            f'bancho:ppvn:{mode}:{country.lower()}',
-            user_id
-        )
+    for user_id in user_ids:
+        rankings[user_id] = {}
 
-        app.session.redis.zrem(
-            f'bancho:pprx:{mode}',
-            user_id
-        )
+        for type in types:
+            rank = next(results)
+            score = next(results)
+            country_rank = next(results) if country else None
 
-        app.session.redis.zrem(
-            f'bancho:pprx:{mode}:{country.lower()}',
-            user_id
-        )
+            rankings[user_id][type] = Ranking(
+                rank=(rank + 1 if rank is not None else 0),
+                score=(score if score is not None else 0),
+                country_rank=(country_rank + 1 if country_rank is not None else 0)
+            )
 
-        app.session.redis.zrem(
-            f'bancho:ppap:{mode}',
-            user_id
-        )
+    return rankings
 
-        app.session.redis.zrem(
-            f'bancho:ppap:{mode}:{country.lower()}',
-            user_id
-        )
+def ranking(
+    user_id: int,
+    mode: int,
+    type: str,
+    country: str | None = None
+) -> Ranking:
+    """Get the rank and score of a player on a single leaderboard"""
+    return ranks_for([user_id], mode, [type], country)[user_id][type]
 
 def global_rank(
     user_id: int,
     mode: int
 ) -> int:
     """Get global rank"""
-    rank = app.session.redis.zrevrank(
-        f'bancho:performance:{mode}',
-        user_id
-    )
-    return (rank + 1 if rank is not None else 0)
+    return ranking(user_id, mode, 'performance').rank
 
 def ppv1_rank(
     user_id: int,
     mode: int
 ) -> int:
     """Get ppv1 rank"""
-    rank = app.session.redis.zrevrank(
-        f'bancho:ppv1:{mode}',
-        user_id
-    )
-    return (rank + 1 if rank is not None else 0)
+    return ranking(user_id, mode, 'ppv1').rank
 
 def country_rank(
     user_id: int,
@@ -281,44 +428,28 @@ def country_rank(
     country: str
 ) -> int:
     """Get country rank"""
-    rank = app.session.redis.zrevrank(
-        f'bancho:performance:{mode}:{country.lower()}',
-        user_id
-    )
-    return (rank + 1 if rank is not None else 0)
+    return ranking(user_id, mode, 'performance', country).country_rank
 
 def score_rank(
     user_id: int,
     mode: int
 ) -> int:
     """Get score rank"""
-    rank = app.session.redis.zrevrank(
-        f'bancho:rscore:{mode}',
-        user_id
-    )
-    return (rank + 1 if rank is not None else 0)
+    return ranking(user_id, mode, 'rscore').rank
 
 def clears_rank(
     user_id: int,
     mode: int
 ) -> int:
     """Get clears rank"""
-    rank = app.session.redis.zrevrank(
-        f'bancho:clears:{mode}',
-        user_id
-    )
-    return (rank + 1 if rank is not None else 0)
+    return ranking(user_id, mode, 'clears').rank
 
 def total_score_rank(
     user_id: int,
     mode: int
 ) -> int:
     """Get total score rank"""
-    rank = app.session.redis.zrevrank(
-        f'bancho:tscore:{mode}',
-        user_id
-    )
-    return (rank + 1 if rank is not None else 0)
+    return ranking(user_id, mode, 'tscore').rank
 
 def score_rank_country(
     user_id: int,
@@ -326,11 +457,7 @@ def score_rank_country(
     country: str
 ) -> int:
     """Get score rank by country"""
-    rank = app.session.redis.zrevrank(
-        f'bancho:rscore:{mode}:{country.lower()}',
-        user_id
-    )
-    return (rank + 1 if rank is not None else 0)
+    return ranking(user_id, mode, 'rscore', country).country_rank
 
 def clears_rank_country(
     user_id: int,
@@ -338,11 +465,7 @@ def clears_rank_country(
     country: str
 ) -> int:
     """Get clears rank by country"""
-    rank = app.session.redis.zrevrank(
-        f'bancho:clears:{mode}:{country.lower()}',
-        user_id
-    )
-    return (rank + 1 if rank is not None else 0)
+    return ranking(user_id, mode, 'clears', country).country_rank
 
 def ppv1_country_rank(
     user_id: int,
@@ -350,11 +473,7 @@ def ppv1_country_rank(
     country: str
 ) -> int:
     """Get country ppv1 rank"""
-    rank = app.session.redis.zrevrank(
-        f'bancho:ppv1:{mode}:{country.lower()}',
-        user_id
-    )
-    return (rank + 1 if rank is not None else 0)
+    return ranking(user_id, mode, 'ppv1', country).country_rank
 
 def total_score_rank_country(
     user_id: int,
@@ -362,132 +481,84 @@ def total_score_rank_country(
     country: str
 ) -> int:
     """Get total score rank by country"""
-    rank = app.session.redis.zrevrank(
-        f'bancho:tscore:{mode}:{country.lower()}',
-        user_id
-    )
-    return (rank + 1 if rank is not None else 0)
+    return ranking(user_id, mode, 'tscore', country).country_rank
 
 def vn_pp_rank(
     user_id: int,
     mode: int
 ) -> int:
     """Get vn pp rank"""
-    rank = app.session.redis.zrevrank(
-        f'bancho:ppvn:{mode}',
-        user_id
-    )
-    return (rank + 1 if rank is not None else 0)
+    return ranking(user_id, mode, 'ppvn').rank
 
 def rx_pp_rank(
     user_id: int,
     mode: int
 ) -> int:
     """Get rx pp rank"""
-    rank = app.session.redis.zrevrank(
-        f'bancho:pprx:{mode}',
-        user_id
-    )
-    return (rank + 1 if rank is not None else 0)
+    return ranking(user_id, mode, 'pprx').rank
 
 def ap_pp_rank(
     user_id: int,
     mode: int
 ) -> int:
     """Get ap pp rank"""
-    rank = app.session.redis.zrevrank(
-        f'bancho:ppap:{mode}', # lol
-        user_id
-    )
-    return (rank + 1 if rank is not None else 0)
+    return ranking(user_id, mode, 'ppap').rank
 
 def performance(
     user_id: int,
     mode: int
 ) -> int:
     """Get player's pp""" # this sounds wrong
-    pp = app.session.redis.zscore(
-        f'bancho:performace:{mode}',
-        user_id
-    )
-    return pp if pp is not None else 0
+    return ranking(user_id, mode, 'performance').score
 
 def score(
     user_id: int,
     mode: int
 ) -> int:
     """Get player's ranked score"""
-    score = app.session.redis.zscore(
-        f'bancho:rscore:{mode}',
-        user_id
-    )
-    return round(score) if score is not None else 0
+    return round(ranking(user_id, mode, 'rscore').score)
 
 def total_score(
     user_id: int,
     mode: int
 ) -> int:
     """Get player's total score"""
-    score = app.session.redis.zscore(
-        f'bancho:tscore:{mode}',
-        user_id
-    )
-    return score if score is not None else 0
+    return ranking(user_id, mode, 'tscore').score
 
 def clears(
     user_id: int,
     mode: int
 ) -> int:
     """Get player's clears"""
-    clears = app.session.redis.zscore(
-        f'bancho:clears:{mode}',
-        user_id
-    )
-    return clears if clears is not None else 0
+    return ranking(user_id, mode, 'clears').score
 
 def accuracy(
     user_id: int,
     mode: int
 ) -> float:
     """Get player's accuracy"""
-    acc = app.session.redis.zscore(
-        f'bancho:acc:{mode}',
-        user_id
-    )
-    return acc if acc is not None else 0
+    return ranking(user_id, mode, 'acc').score
 
 def vn_pp(
     user_id: int,
     mode: int
 ) -> float:
     """Get player's vn pp"""
-    pp = app.session.redis.zscore(
-        f'bancho:ppvn:{mode}',
-        user_id
-    )
-    return pp if pp is not None else 0
+    return ranking(user_id, mode, 'ppvn').score
 
 def rx_pp(
     user_id: int,
     mode: int
 ) -> float:
     """Get player's rx pp"""
-    pp = app.session.redis.zscore(
-        f'bancho:pprx:{mode}',
-        user_id
-    )
-    return pp if pp is not None else 0
+    return ranking(user_id, mode, 'pprx').score
 
 def ap_pp(
     user_id: int,
     mode: int
 ) -> float:
     """Get player's ap pp"""
-    pp = app.session.redis.zscore(
-        f'bancho:ppap:{mode}',
-        user_id
-    )
-    return pp if pp is not None else 0
+    return ranking(user_id, mode, 'ppap').score
 
 def top_players(
     mode: int,
@@ -511,57 +582,119 @@ def top_players(
 
     return [(int(id), score) for id, score in players]
 
-def top_countries(mode: int) -> List[dict]:
-    """Get a list of the top countries"""
-    country_rankings = []
-
-    for country in countries.keys():
-        if country == 'XX':
-            continue
+def scan_ranks(
+    mode: int,
+    type: str = 'performance',
+    country: str | None = None,
+    chunk_size: int = 10000
+) -> Generator[Tuple[int, int, float], None, None]:
+    """Iterate over a whole leaderboard in chunks, deriving the ranks from their position
 
-        country_performance = app.session.redis.zrevrangebyscore(
-            f'bancho:performance:{mode}:{country.lower()}',
-            '+inf',
-            '1',
+    `returns`: Generator[Tuple[player_id, rank, score/pp]]
+    """
+    key = f'bancho:{type}:{mode}{f":{country.lower()}" if country else ""}'
+    offset = 0
+
+    while True:
+        entries = app.session.redis.zrevrange(
+            key,
+            offset,
+            offset + chunk_size - 1,
             withscores=True
         )
 
-        if not country_performance:
-            continue
+        for index, (id, score) in enumerate(entries):
+            yield int(id), offset + index + 1, score
 
-        country_rscore = app.session.redis.zrevrangebyscore(
-            f'bancho:rscore:{mode}:{country.lower()}',
-            '+inf',
-            '1',
-            withscores=True
-        )
+        if len(entries) < chunk_size:
+            break
 
-        if not country_rscore:
-            continue
+        offset += chunk_size
 
-        country_tscore = app.session.redis.zrevrangebyscore(
-            f'bancho:tscore:{mode}:{country.lower()}',
-            '+inf',
-            '1',
-            withscores=True
+def country_ranks(
+    mode: int,
+    type: str = 'performance'
+) -> Dict[int, int]:
+    """Get the country rank of every player, fetching all country leaderboards in one round trip
+
+    `returns`: Dict[player_id, country_rank]
+    """
+    pipe = app.session.redis.pipeline(transaction=False)
+
+    for country in countries.keys():
+        pipe.zrevrange(f'bancho:{type}:{mode}:{country.lower()}', 0, -1)
+
+    return {
+        int(id): index + 1
+        for members in pipe.execute()
+        for index, id in enumerate(members)
+    }
+
+def rebuild_country_totals(mode: int) -> None:
+    """Recalculate the country totals from the country leaderboards.
+
+    Every country is calculated inside of one script, so updates that run
+    in the meantime are either included, or applied on top of the new totals.
+    """
+    pipe = app.session.redis.pipeline(transaction=False)
+    pipe.delete(f'bancho:countries:{mode}')
+
+    for country in countries.keys():
+        queue_script(
+            pipe,
+            COUNTRY_TOTALS_SCRIPT,
+            keys=[
+                *(
+                    f'bancho:{type}:{mode}:{country.lower()}'
+                    for type in COUNTRY_TOTAL_TYPES
+                ),
+                f'bancho:countries:{mode}'
+            ],
+            args=[country.lower()],
+            inline=False
         )
 
-        if not country_tscore:
-            continue
+    pipe.set(f'bancho:countries:{mode}:indexed', 1)
+    pipe.execute()
+
+def top_countries(mode: int) -> List[dict]:
+    """Get a list of the top countries"""
+    pipe = app.session.redis.pipeline(transaction=False)
+    pipe.exists(f'bancho:countries:{mode}:indexed')
+    pipe.hgetall(f'bancho:countries:{mode}')
+    indexed, totals = pipe.execute()
+
+    if not indexed and app.session.redis.set(
+        f'bancho:countries:{mode}:lock', 1,
+        ex=60, nx=True
+    ):
+        # Totals were not calculated yet, and no one else is calculating them
+        try:
+            rebuild_country_totals(mode)
+            totals = app.session.redis.hgetall(f'bancho:countries:{mode}')
+        finally:
+            app.session.redis.delete(f'bancho:countries:{mode}:lock')
+    country_totals: Dict[str, Dict[str, float]] = {}
+
+    for field, value in totals.items():
+        country, total = field.decode().split(':')
+        country_totals.setdefault(country, {})[total] = float(value)
+
+    country_rankings = []
 
-        total_performance = sum(score for member, score in country_performance)
-        total_rscore = sum(score for member, score in country_rscore)
-        total_tscore = sum(score for member, score in country_tscore)
-        total_users = len(country_performance)
-        average_pp = total_performance / total_users
+    for country, total in country_totals.items():
+        total_users = round(total.get('users', 0))
+
+        if country == 'xx' or total_users <= 0:
+            continue
 
         country_rankings.append({
-            'name': country.lower(),
-            'total_performance': total_performance,
-            'total_rscore': total_rscore,
-            'total_tscore': total_tscore,
+            'name': country,
+            'total_performance': total.get('performance', 0.0),
+            'total_rscore': total.get('rscore', 0.0),
+            'total_tscore': total.get('tscore', 0.0),
             'total_users': total_users,
-            'average_pp': average_pp
+            'average_pp': total.get('performance', 0.0) / total_users
         })
 
     country_rankings.sort(
@@ -0,0 +1,259 @@
+
+from __future__ import annotations
+
+from abc import ABC, abstractmethod
+from typing import Any, Callable, Dict, Tuple
+
+import struct
+import timeit
+import ast
+
+Event = Tuple[str, tuple, dict]
+
+class Serializer(ABC):
+    """Base class for encoding & decoding events of the event queue"""
+
+    @abstractmethod
+    def encode(self, event: str, args: tuple, kwargs: dict) -> bytes:
+        ...
+
+    @abstractmethod
+    def decode(self, data: bytes) -> Event:
+        ...
+
+class LegacySerializer(Serializer):
+    """Encodes events with `repr`, which is the format that was used before the binary codec.
+
+    Decoding is done with `ast.literal_eval`, so that messages can't execute any code.
+    """
+
+    def encode(self, event: str, args: tuple, kwargs: dict) -> bytes:
+        return str((event, args, kwargs)).encode()
+
+    def decode(self, data: bytes) -> Event:
+        if isinstance(data, (bytes, bytearray)):
+            data = data.decode()
+
+        return ast.literal_eval(data)
+
+class BinarySerializer(Serializer):
+    """Compact, type-tagged binary codec with a leading version byte.
+
+    Supports None, bool, int, float, str, bytes, list, tuple & dict values.
+    Messages that don't start with the version byte get passed to the
+    legacy decoder, so that both formats can be used during a migration.
+    With `encode_legacy`, events are still published in the legacy format,
+    until every listener has been upgraded to decode the binary format.
+    """
+
+    VERSION = 0x01
+
+    U32 = struct.Struct('<I')
+    S64 = struct.Struct('<q')
+    DOUBLE = struct.Struct('<d')
+
+    def __init__(
+        self,
+        legacy: Serializer | None = LegacySerializer(),
+        encode_legacy: bool = False
+    ) -> None:
+        self.legacy = legacy
+        self.encode_legacy = encode_legacy
+
+        self.encoders: Dict[type, Callable[[bytearray, Any], None]] = {
+            type(None): self.encode_none,
+            bool: self.encode_bool,
+            int: self.encode_int,
+            float: self.encode_float,
+            str: self.encode_str,
+            bytes: self.encode_bytes,
+            list: self.encode_list,
+            tuple: self.encode_tuple,
+            dict: self.encode_dict
+        }
+
+        self.decoders: Dict[int, Callable[[memoryview, int], Tuple[Any, int]]] = {
+            ord('N'): lambda data, pos: (None, pos),
+            ord('T'): lambda data, pos: (True, pos),
+            ord('F'): lambda data, pos: (False, pos),
+            ord('i'): self.decode_int,
+            ord('I'): self.decode_bigint,
+            ord('d'): self.decode_float,
+            ord('s'): self.decode_str,
+            ord('b'): self.decode_bytes,
+            ord('l'): self.decode_list,
+            ord('t'): self.decode_tuple,
+            ord('m'): self.decode_dict
+        }
+
+    def encode(self, event: str, args: tuple, kwargs: dict) -> bytes:
+        if self.encode_legacy and self.legacy:
+            return self.legacy.encode(event, args, kwargs)
+
+        buffer = bytearray([self.VERSION])
+        self.encode_value(buffer, (event, args, kwargs))
+        return bytes(buffer)
+
+    def decode(self, data: bytes) -> Event:
+        if not data or data[0] != self.VERSION:
+            if not self.legacy:
+                raise ValueError('Unsupported message format')
+
+            return self.legacy.decode(data)
+
+        (event, args, kwargs), _ = self.decode_value(memoryview(data), 1)
+        return event, args, kwargs
+
+    def encode_value(self, buffer: bytearray, value: Any) -> None:
+        if not (encoder := self.encoders.get(type(value))):
+            raise TypeError(f'Unsupported type: "{type(value).__name__}"')
+
+        encoder(buffer, value)
+
+    def encode_none(self, buffer: bytearray, value: None) -> None:
+        buffer += b'N'
+
+    def encode_bool(self, buffer: bytearray, value: bool) -> None:
+        buffer += b'T' if value else b'F'
+
+    def encode_int(self, buffer: bytearray, value: int) -> None:
+        if -0x8000000000000000 <= value <= 0x7FFFFFFFFFFFFFFF:
+            buffer += b'i'
+            buffer += self.S64.pack(value)
+            return
+
+        # Numbers outside of 64 bits are stored as text
+        self.encode_sized(buffer, b'I', str(value).encode())
+
+    def encode_float(self, buffer: bytearray, value: float) -> None:
+        buffer += b'd'
+        buffer += self.DOUBLE.pack(value)
+
+    def encode_str(self, buffer: bytearray, value: str) -> None:
+        self.encode_sized(buffer, b's', value.encode())
+
+    def encode_bytes(self, buffer: bytearray, value: bytes) -> None:
+        self.encode_sized(buffer, b'b', value)
+
+    def encode_sized(self, buffer: bytearray, tag: bytes, value: bytes) -> None:
+        buffer += tag
+        buffer += self.U32.pack(len(value))
+        buffer += value
+
+    def encode_list(self, buffer: bytearray, value: list) -> None:
+        self.encode_sequence(buffer, b'l', value)
+
+    def encode_tuple(self, buffer: bytearray, value: tuple) -> None:
+        self.encode_sequence(buffer, b't', value)
+
+    def encode_sequence(self, buffer: bytearray, tag: bytes, value: list | tuple) -> None:
+        buffer += tag
+        buffer += self.U32.pack(len(value))
+
+        for item in value:
+            self.encode_value(buffer, item)
+
+    def encode_dict(self, buffer: bytearray, value: dict) -> None:
+        buffer += b'm'
+        buffer += self.U32.pack(len(value))
+
+        for key, item in value.items():
+            self.encode_value(buffer, key)
+            self.encode_value(buffer, item)
+
+    def decode_value(self, data: memoryview, pos: int) -> Tuple[Any, int]:
+        if not (decoder := self.decoders.get(data[pos])):
+            raise ValueError(f'Invalid type tag at position {pos}')
+
+        return decoder(data, pos + 1)
+
+    def decode_int(self, data: memoryview, pos: int) -> Tuple[int, int]:
+        return self.S64.unpack_from(data, pos)[0], pos + 8
+
+    def decode_bigint(self, data: memoryview, pos: int) -> Tuple[int, int]:
+        value, pos = self.decode_bytes(data, pos)
+        return int(value), pos
+
+    def decode_float(self, data: memoryview, pos: int) -> Tuple[float, int]:
+        return self.DOUBLE.unpack_from(data, pos)[0], pos + 8
+
+    def decode_str(self, data: memoryview, pos: int) -> Tuple[str, int]:
+        value, pos = self.decode_bytes(data, pos)
+        return value.decode(), pos
+
+    def decode_bytes(self, data: memoryview, pos: int) -> Tuple[bytes, int]:
+        size = self.U32.unpack_from(data, pos)[0]
+        pos += 4
+
+        if pos + size > len(data):
+            raise OverflowError('Buffer overflow')
+
+        return bytes(data[pos:pos + size]), pos + size
+
+    def decode_list(self, data: memoryview, pos: int) -> Tuple[list, int]:
+        count = self.U32.unpack_from(data, pos)[0]
+        pos += 4
+        items = []
+
+        for _ in range(count):
+            item, pos = self.decode_value(data, pos)
+            items.append(item)
+
+        return items, pos
+
+    def decode_tuple(self, data: memoryview, pos: int) -> Tuple[tuple, int]:
+        items, pos = self.decode_list(data, pos)
+        return tuple(items), pos
+
+    def decode_dict(self, data: memoryview, pos: int) -> Tuple[dict, int]:
+        count = self.U32.unpack_from(data, pos)[0]
+        pos += 4
+        items = {}
+
+        for _ in range(count):
+            key, pos = self.decode_value(data, pos)
+            items[key], pos = self.decode_value(data, pos)
+
+        return items, pos
+
+def benchmark(
+    event: Event = (
+        'user_update',
+        (2, 'peppy', [727] * 50),
+        {'mode': 0, 'pp': 1234.56, 'country': 'AU', 'flags': {'restricted': False}}
+    ),
+    iterations: int = 10000
+) -> Dict[str, Dict[str, float]]:
+    """Compare encode & decode throughput of the available serializers,
+    as well as the old `repr`/`eval` transport.
+
+    `returns`: Dict[serializer, Dict[operation, operations per second]]
+    """
+    legacy = LegacySerializer()
+    binary = BinarySerializer()
+
+    legacy_data = legacy.encode(*event)
+    binary_data = binary.encode(*event)
+
+    operations = {
+        'eval': {
+            'encode': lambda: str(event),
+            'decode': lambda: eval(legacy_data)
+        },
+        'legacy': {
+            'encode': lambda: legacy.encode(*event),
+            'decode': lambda: legacy.decode(legacy_data)
+        },
+        'binary': {
+            'encode': lambda: binary.encode(*event),
+            'decode': lambda: binary.decode(binary_data)
+        }
+    }
+
+    return {
+        name: {
+            operation: iterations / timeit.timeit(function, number=iterations)
+            for operation, function in functions.items()
+        }
+        for name, functions in operations.items()
+    }
@@ -3,51 +3,142 @@ from __future__ import annotations
 
 from ..constants import ClientStatus, GameMode, Mods
 from ..objects import bStatusUpdate
-from copy import copy
+from datetime import timedelta
+from typing import Iterable, Dict
 
+import struct
+import time
 import app
 
-def update(player_id: int, status: bStatusUpdate, client_hash: str, version: int) -> None:
-    status = copy(status)
-
-    for key, value in {
-        'beatmap_checksum': status.beatmap_checksum,
-        'beatmap_id': status.beatmap_id,
-        'action': status.action.value,
-        'mods': status.mods.value,
-        'mode': status.mode.value,
-        'hash': client_hash,
-        'text': status.text,
-        'version': version,
-    }.items():
-        app.session.redis.hset(
-            f'bancho:status:{player_id}',
-            key, value
-        )
+# action, mode, mods, beatmap_id
+STATUS = struct.Struct('<BBIi')
+
+def update(
+    player_id: int,
+    status: bStatusUpdate,
+    client_hash: str,
+    version: int,
+    expiry: timedelta | None = None
+) -> None:
+    pipe = app.session.redis.pipeline()
+    pipe.hset(
+        f'bancho:status:{player_id}',
+        mapping={
+            'status': STATUS.pack(
+                status.action.value,
+                status.mode.value,
+                status.mods.value,
+                status.beatmap_id
+            ),
+            'beatmap_checksum': status.beatmap_checksum,
+            'text': status.text,
+            'hash': client_hash,
+            'version': version
+        }
+    )
+
+    if expiry is not None:
+        pipe.expire(f'bancho:status:{player_id}', expiry)
+
+    # The index is scored by the expiry time of the status,
+    # so that expired players can be removed from it on read
+    pipe.zadd(
+        'bancho:online:players',
+        {player_id: time.time() + expiry.total_seconds() if expiry else '+inf'}
+    )
+    pipe.execute()
 
 def get(player_id: int) -> bStatusUpdate | None:
     status = app.session.redis.hgetall(
         f'bancho:status:{player_id}'
     )
 
+    return parse(status)
+
+def parse(status: dict) -> bStatusUpdate | None:
     if not status:
         return
 
+    if b'status' not in status:
+        # Status was written in the old format
+        return bStatusUpdate(
+            action=ClientStatus(int(status[b'action'])),
+            mode=GameMode(int(status[b'mode'])),
+            mods=Mods(int(status[b'mods'])),
+            beatmap_id=int(status[b'beatmap_id']),
+            beatmap_checksum=status[b'beatmap_checksum'].decode(),
+            text=status[b'text'].decode(),
+        )
+
+    action, mode, mods, beatmap_id = STATUS.unpack(status[b'status'])
+
     return bStatusUpdate(
-        action=ClientStatus(int(status[b'action'])),
-        mode=GameMode(int(status[b'mode'])),
-        mods=Mods(int(status[b'mods'])),
-        beatmap_id=int(status[b'beatmap_id']),
+        action=ClientStatus(action),
+        mode=GameMode(mode),
+        mods=Mods(mods),
+        beatmap_id=beatmap_id,
         beatmap_checksum=status[b'beatmap_checksum'].decode(),
         text=status[b'text'].decode(),
     )
 
+def get_many(player_ids: Iterable[int]) -> Dict[int, bStatusUpdate | None]:
+    """Get the status of multiple players inside a single round trip"""
+    player_ids = list(player_ids)
+    pipe = app.session.redis.pipeline(transaction=False)
+
+    for player_id in player_ids:
+        pipe.hgetall(f'bancho:status:{player_id}')
+
+    return {
+        player_id: parse(status)
+        for player_id, status in zip(player_ids, pipe.execute())
+    }
+
 def get_all() -> list[str]:
     return [
-        key.decode()
-        for key in app.session.redis.keys('bancho:status:*')
+        f'bancho:status:{player_id}'
+        for player_id in online()
     ]
 
+def online() -> list[int]:
+    """Get the ids of all players, that have a status"""
+    if not app.session.redis.exists('bancho:online:players:indexed'):
+        # Index was not created yet
+        return rebuild_index()
+
+    pipe = app.session.redis.pipeline()
+    pipe.zremrangebyscore('bancho:online:players', '-inf', time.time())
+    pipe.zrange('bancho:online:players', 0, -1)
+    _, player_ids = pipe.execute()
+
+    return [int(player_id) for player_id in player_ids]
+
+def rebuild_index() -> list[int]:
+    """Recreate the index of online players, by scanning for status keys"""
+    keys = list(app.session.redis.scan_iter('bancho:status:*', count=1000))
+
+    pipe = app.session.redis.pipeline(transaction=False)
+
+    for key in keys:
+        pipe.ttl(key)
+
+    now = time.time()
+    players = {}
+
+    for key, ttl in zip(keys, pipe.execute()):
+        if ttl == -2:
+            # Status has expired in the meantime
+            continue
+
+        player_id = int(key.decode().removeprefix('bancho:status:'))
+        players[player_id] = now + ttl if ttl >= 0 else '+inf'
+
+    if players:
+        app.session.redis.zadd('bancho:online:players', players)
+
+    app.session.redis.set('bancho:online:players:indexed', 1)
+    return list(players)
+
 def client_hash(player_id: int) -> str | None:
     hash = app.session.redis.hget(
         f'bancho:status:{player_id}',
@@ -71,10 +162,10 @@ def version(player_id: int) -> int | None:
     return int(version)
 
 def delete(player_id: int) -> None:
-    app.session.redis.hdel(
-        f'bancho:status:{player_id}',
-        'action', 'mode', 'mods', 'text', 'beatmap_id', 'beatmap_checksum', 'hash', 'version'
-    )
+    pipe = app.session.redis.pipeline()
+    pipe.delete(f'bancho:status:{player_id}')
+    pipe.zrem('bancho:online:players', player_id)
+    pipe.execute()
 
 def exists(player_id: int) -> bool:
     return app.session.redis.exists(
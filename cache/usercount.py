@@ -1,6 +1,90 @@
 
+from __future__ import annotations
+
+from redis.commands.core import Script
+
+import threading
+import atexit
 import app
 
+# KEYS: usercount
+# ARGV: amount
+DECREMENT_SCRIPT = """
+local count = redis.call('DECRBY', KEYS[1], ARGV[1])
+
+if count < 0 then
+    redis.call('SET', KEYS[1], 0)
+    return 0
+end
+
+return count
+"""
+
+class Accumulator:
+    """Collects usercount changes locally, and flushes them to redis in a fixed interval"""
+
+    def __init__(self, interval: float = 1.0) -> None:
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.delta = 0
+
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(
+            target=self.run,
+            name='usercount-accumulator',
+            daemon=True
+        )
+
+    def add(self, amount: int) -> None:
+        with self.lock:
+            self.delta += amount
+
+    def flush(self) -> None:
+        with self.lock:
+            delta, self.delta = self.delta, 0
+
+        try:
+            if delta > 0:
+                app.session.redis.incrby('bancho:users', delta)
+
+            elif delta < 0:
+                decrement_remote(-delta)
+        except Exception:
+            # Keep the changes for the next flush
+            self.add(delta)
+            raise
+
+    def run(self) -> None:
+        while not self.stopped.wait(self.interval):
+            try:
+                self.flush()
+            except Exception as e:
+                app.session.logger.warning(
+                    f'Failed to flush usercount: {e}',
+                    exc_info=e
+                )
+
+    def start(self) -> None:
+        self.thread.start()
+        atexit.register(self.stop)
+
+    def stop(self) -> None:
+        self.stopped.set()
+        self.flush()
+
+accumulator: Accumulator | None = None
+decrement_script: Script | None = None
+
+def enable_accumulator(interval: float = 1.0) -> Accumulator:
+    """Buffer increments & decrements of this process, to reduce writes during login storms"""
+    global accumulator
+
+    if accumulator is None:
+        accumulator = Accumulator(interval)
+        accumulator.start()
+
+    return accumulator
+
 def set(count: int) -> None:
     app.session.redis.set(
         'bancho:users',
@@ -14,7 +98,25 @@ def get() -> int:
     return int(count)
 
 def increment(amount: int = 1) -> None:
-    set(get() + amount)
+    if accumulator is not None:
+        return accumulator.add(amount)
+
+    app.session.redis.incrby('bancho:users', amount)
 
 def decrement(amount: int = 1) -> None:
-    set(get() - amount)
+    if accumulator is not None:
+        return accumulator.add(-amount)
+
+    decrement_remote(amount)
+
+def decrement_remote(amount: int) -> int:
+    """Decrement the usercount atomically, without going below zero"""
+    global decrement_script
+
+    if decrement_script is None:
+        decrement_script = app.session.redis.register_script(DECREMENT_SCRIPT)
+
+    return decrement_script(
+        keys=['bancho:users'],
+        args=[amount]
+    )
@@ -118,14 +118,21 @@ def update_rank(
     country: str,
     session: Session = ...
 ) -> None:
-    country_rank = leaderboards.country_rank(stats.user_id, stats.mode, country)
-    global_rank = leaderboards.global_rank(stats.user_id, stats.mode)
-    score_rank = leaderboards.score_rank(stats.user_id, stats.mode)
-    ppv1_rank = leaderboards.ppv1_rank(stats.user_id, stats.mode)
-
-    pp_vn_rank = leaderboards.vn_pp_rank(stats.user_id, stats.mode)
-    pp_rx_rank = leaderboards.rx_pp_rank(stats.user_id, stats.mode)
-    pp_ap_rank = leaderboards.ap_pp_rank(stats.user_id, stats.mode)
+    rankings = leaderboards.ranks_for(
+        [stats.user_id],
+        stats.mode,
+        ['performance', 'rscore', 'ppv1', 'ppvn', 'pprx', 'ppap'],
+        country
+    )[stats.user_id]
+
+    country_rank = rankings['performance'].country_rank
+    global_rank = rankings['performance'].rank
+    score_rank = rankings['rscore'].rank
+    ppv1_rank = rankings['ppv1'].rank
+
+    pp_vn_rank = rankings['ppvn'].rank
+    pp_rx_rank = rankings['pprx'].rank
+    pp_ap_rank = rankings['ppap'].rank
 
     if any([
         global_rank <= 0,
@@ -156,6 +163,79 @@ def update_rank(
     )
     session.commit()
 
+@session_wrapper
+def snapshot_ranks(
+    mode: int,
+    batch_size: int = 5000,
+    session: Session = ...
+) -> int:
+    """Create a rank history entry for every player on the leaderboards.
+
+    Ranks are derived from the position inside of the leaderboards, so that
+    every leaderboard only needs to be scanned once, instead of looking up
+    the ranks of every player one by one.
+
+    `returns`: The amount of inserted entries
+    """
+    types = ('performance', 'rscore', 'ppv1', 'ppvn', 'pprx', 'ppap')
+    country_ranks = leaderboards.country_ranks(mode)
+    rankings = {
+        type: {
+            user_id: (rank, score)
+            for user_id, rank, score in leaderboards.scan_ranks(mode, type)
+        }
+        for type in types
+    }
+
+    time = datetime.now()
+    entries = []
+    count = 0
+
+    for user_id, (global_rank, pp) in rankings['performance'].items():
+        if any([
+            user_id not in country_ranks,
+            user_id not in rankings['rscore'],
+            user_id not in rankings['ppv1']
+        ]):
+            continue
+
+        score_rank, rscore = rankings['rscore'][user_id]
+        ppv1_rank, ppv1 = rankings['ppv1'][user_id]
+        pp_vn_rank, pp_vn = rankings['ppvn'].get(user_id, (0, 0))
+        pp_rx_rank, pp_rx = rankings['pprx'].get(user_id, (0, 0))
+        pp_ap_rank, pp_ap = rankings['ppap'].get(user_id, (0, 0))
+
+        entries.append({
+            'user_id': user_id,
+            'time': time,
+            'mode': mode,
+            'rscore': int(rscore),
+            'pp': pp,
+            'ppv1': ppv1,
+            'pp_vn': pp_vn,
+            'pp_rx': pp_rx,
+            'pp_ap': pp_ap,
+            'global_rank': global_rank,
+            'country_rank': country_ranks[user_id],
+            'score_rank': score_rank,
+            'ppv1_rank': ppv1_rank,
+            'pp_vn_rank': pp_vn_rank,
+            'pp_rx_rank': pp_rx_rank,
+            'pp_ap_rank': pp_ap_rank
+        })
+
+        if len(entries) >= batch_size:
+            session.bulk_insert_mappings(DBRankHistory, entries)
+            count += len(entries)
+            entries = []
+
+    if entries:
+        session.bulk_insert_mappings(DBRankHistory, entries)
+        count += len(entries)
+
+    session.commit()
+    return count
+
 @session_wrapper
 def fetch_rank_history(
     user_id: int,
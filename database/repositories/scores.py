@@ -8,6 +8,7 @@ from app.common.database.objects import (
 )
 
 from sqlalchemy.orm import selectinload, Session
+from sqlalchemy.engine import Row
 from sqlalchemy import or_, and_, func
 
 from collections import defaultdict
@@ -53,6 +54,34 @@ def fetch_by_id(id: int, session: Session = ...) -> DBScore | None:
         .filter(DBScore.id == id) \
         .first()
 
+@session_wrapper
+def fetch_replay_header(id: int, session: Session = ...) -> Row | None:
+    """Fetch only the columns, that are required to build the header of a replay file"""
+    return session.query(
+            DBScore.id,
+            DBScore.mode,
+            DBScore.client_version,
+            DBScore.n300,
+            DBScore.n100,
+            DBScore.n50,
+            DBScore.nGeki,
+            DBScore.nKatu,
+            DBScore.nMiss,
+            DBScore.total_score,
+            DBScore.max_combo,
+            DBScore.perfect,
+            DBScore.mods,
+            DBScore.grade,
+            DBScore.failtime,
+            DBScore.submitted_at,
+            DBBeatmap.md5.label('beatmap_md5'),
+            DBUser.name.label('username')
+        ) \
+        .join(DBBeatmap, DBBeatmap.id == DBScore.beatmap_id) \
+        .join(DBUser, DBUser.id == DBScore.user_id) \
+        .filter(DBScore.id == id) \
+        .first()
+
 @session_wrapper
 def fetch_by_replay_checksum(checksum: str, session: Session = ...) -> DBScore | None:
     return session.query(DBScore) \
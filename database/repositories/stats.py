@@ -5,10 +5,11 @@ from app.common.database.objects import (
     DBReplayHistory,
     DBBeatmap,
     DBStats,
-    DBScore
+    DBScore,
+    DBUser
 )
 
-from sqlalchemy.orm import Session
+from sqlalchemy.orm import Session, Query
 from sqlalchemy import func
 from typing import List
 
@@ -84,6 +85,29 @@ def fetch_all(user_id: int, session: Session = ...) -> List[DBStats]:
         .filter(DBStats.user_id == user_id) \
         .all()
 
+def fetch_leaderboard_entries(
+    mode: int | None = None,
+    batch_size: int = 5000,
+    *,
+    session: Session
+) -> Query:
+    """Stream stats of all unrestricted users, together with their country.
+
+    The returned query uses a server-side cursor, so it has to be consumed
+    while the given session is still open, which is why a session is required.
+    Users without a country are returned with "XX".
+    """
+    query = session.query(DBStats, func.coalesce(DBUser.country, 'XX')) \
+        .join(DBUser, DBUser.id == DBStats.user_id) \
+        .filter(DBUser.restricted == False)
+
+    if mode is not None:
+        query = query.filter(DBStats.mode == mode)
+
+    return query \
+        .execution_options(stream_results=True) \
+        .yield_per(batch_size)
+
 @session_wrapper
 def restore(user_id: int, session: Session = ...) -> None:
     """Recalculate stats from scratch"""
@@ -3,6 +3,7 @@ from .external import location
 
 from . import performance
 from . import external
+from . import compression
 from . import caching
 from . import replays
 from . import clients
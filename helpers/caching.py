@@ -1,7 +1,11 @@
 
 from datetime import timedelta, datetime
 from functools import lru_cache, wraps
-from typing import Callable
+from typing import Any, Callable, Dict, Tuple
+from collections import OrderedDict
+
+import threading
+import time
 
 def ttl_cache(maxsize: int = 128, typed: bool = False, ttl: int = -1):
     ttl = 0x10000 if ttl <= 0 else ttl
@@ -30,3 +34,113 @@ def ttl_cache(maxsize: int = 128, typed: bool = False, ttl: int = -1):
         wrapped_func.cache_clear = cache_clear
         return wrapped_func
     return wrapper
+
+class Flight:
+    def __init__(self) -> None:
+        self.done = threading.Event()
+        self.error: Exception | None = None
+        self.result: Any = None
+
+class SingleFlight:
+    """Makes sure that only one call per key is in flight, while other callers wait for its result"""
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.flights: Dict[str, Flight] = {}
+
+    def do(self, key: str, func: Callable[[], Any]) -> Any:
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+
+            if leader:
+                flight = self.flights[key] = Flight()
+
+        if not leader:
+            flight.done.wait()
+
+            if flight.error:
+                raise flight.error
+
+            return flight.result
+
+        try:
+            flight.result = func()
+            return flight.result
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.flights[key]
+
+            flight.done.set()
+
+class LocalCache:
+    """Bounded in-process LRU cache with a ttl, that is limited by the total size of its values"""
+
+    def __init__(self, max_size: int, ttl: float = 30.0) -> None:
+        self.max_size = max_size
+        self.max_item_size = max_size // 4
+        self.ttl = ttl
+
+        self.lock = threading.Lock()
+        self.entries: OrderedDict[str, Tuple[bytes, float]] = OrderedDict()
+        self.size = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: str) -> bytes | None:
+        with self.lock:
+            if not (entry := self.entries.get(key)):
+                self.misses += 1
+                return
+
+            value, expires = entry
+
+            if expires < time.monotonic():
+                self.pop(key)
+                self.misses += 1
+                return
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: str, value: bytes) -> None:
+        if len(value) > self.max_item_size:
+            return
+
+        with self.lock:
+            self.pop(key)
+            self.entries[key] = (value, time.monotonic() + self.ttl)
+            self.size += len(value)
+
+            while self.size > self.max_size:
+                _, (evicted, _) = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+                self.evictions += 1
+
+    def remove(self, key: str) -> None:
+        with self.lock:
+            self.pop(key)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def pop(self, key: str) -> None:
+        if (entry := self.entries.pop(key, None)):
+            self.size -= len(entry[0])
+
+    def as_dict(self) -> dict:
+        return {
+            'entries': len(self.entries),
+            'size': self.size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions
+        }
@@ -0,0 +1,59 @@
+
+from __future__ import annotations
+
+from typing import Callable, Dict
+
+import zlib
+
+# Prefix for compressed values, followed by the id of the codec.
+# Values without this prefix are returned as they are, which
+# keeps values written before compression was enabled readable.
+MAGIC = b'\xc5\x5a'
+
+class Codec:
+    def __init__(
+        self,
+        id: int,
+        name: str,
+        compress: Callable[[bytes], bytes],
+        decompress: Callable[[bytes], bytes]
+    ) -> None:
+        self.id = id
+        self.name = name
+        self.compress = compress
+        self.decompress = decompress
+
+NONE = Codec(0, 'none', bytes, bytes)
+ZLIB = Codec(1, 'zlib', lambda data: zlib.compress(data, 6), zlib.decompress)
+ZLIB_FAST = Codec(2, 'zlib-fast', lambda data: zlib.compress(data, 1), zlib.decompress)
+
+CODECS: Dict[str, Codec] = {
+    codec.name: codec
+    for codec in (NONE, ZLIB, ZLIB_FAST)
+}
+
+CODEC_IDS: Dict[int, Codec] = {
+    codec.id: codec
+    for codec in CODECS.values()
+}
+
+def compress(data: bytes, codec: str) -> bytes:
+    """Compress data with a header, unless that doesn't make it any smaller"""
+    if (codec := CODECS[codec]) is not NONE:
+        compressed = codec.compress(data)
+
+        if len(compressed) + len(MAGIC) + 1 < len(data):
+            return MAGIC + bytes([codec.id]) + compressed
+
+    if data.startswith(MAGIC):
+        # Raw data that happens to start with the magic needs a header as well
+        return MAGIC + bytes([NONE.id]) + data
+
+    return data
+
+def decompress(data: bytes) -> bytes:
+    if not data.startswith(MAGIC):
+        return data
+
+    codec = CODEC_IDS[data[len(MAGIC)]]
+    return codec.decompress(data[len(MAGIC) + 1:])
@@ -1,10 +1,179 @@
 
+from ..objects import bReplayFrame, bReplayFrameBundle, bScoreFrame
+from ..objects.schemas import ScoreFrameSchema
 from ..database.objects import DBScore
+from ..constants import ButtonState
+from ..streams import StreamOut
+
+from dataclasses import dataclass, field
 from datetime import datetime
+from typing import Dict, List
+from array import array
+from enum import Enum
 
 import hashlib
+import timeit
+import struct
+import sys
+
+# Offset, size & array typecode of each column inside a bancho replay frame
+FRAME_LAYOUT = {
+    'button_state': (0, 1, 'B'),
+    'legacy_byte': (1, 1, 'B'),
+    'mouse_x': (2, 4, 'f'),
+    'mouse_y': (6, 4, 'f'),
+    'time': (10, 4, 'i')
+}
+
+FRAME_SIZE = 14
+FRAME = struct.Struct('<BBffi')
+
+# Time of the frame, that stores the rng seed inside of an .osr file
+SEED_FRAME_TIME = -12345
+
+@dataclass(frozen=True, slots=True)
+class EncodedPacket:
+    """Serialized packet including its header, that can be shared between connections"""
+    packet: Enum
+    data: bytes
+    header_size: int
+
+    @property
+    def payload(self) -> memoryview:
+        return memoryview(self.data)[self.header_size:]
+
+@dataclass(slots=True)
+class FrameColumns:
+    """Replay frames stored as one array per column, instead of one object per frame.
+    The arrays support the buffer protocol, e.g. for `numpy.frombuffer`.
+    """
+    time: array = field(default_factory=lambda: array('i'))
+    mouse_x: array = field(default_factory=lambda: array('f'))
+    mouse_y: array = field(default_factory=lambda: array('f'))
+    button_state: array = field(default_factory=lambda: array('B'))
+    legacy_byte: array = field(default_factory=lambda: array('B'))
+
+    def __len__(self) -> int:
+        return len(self.time)
+
+    def frames(self) -> List[bReplayFrame]:
+        return [
+            bReplayFrame(ButtonState(button_state), legacy_byte, mouse_x, mouse_y, time)
+            for time, mouse_x, mouse_y, button_state, legacy_byte in zip(
+                self.time,
+                self.mouse_x,
+                self.mouse_y,
+                self.button_state,
+                self.legacy_byte
+            )
+        ]
+
+@dataclass(slots=True)
+class ReplayFrameColumns(FrameColumns):
+    """Frames of an .osr file, where the rng seed frame is kept separate from the
+    columns, since the seed does not fit into the column of the button state.
+    """
+    seed: int | None = None
+
+def decode_frames(data: bytes) -> FrameColumns:
+    """Decode frames in the format of a bancho `ReplayFrameBundle` into columns
+
+    The columns get gathered from the interleaved frames with strided
+    copies, so no per-frame python objects are created.
+    """
+    count = len(data) // FRAME_SIZE
+    frames = memoryview(data)[:count * FRAME_SIZE]
+    columns = FrameColumns()
+
+    for name, (offset, size, typecode) in FRAME_LAYOUT.items():
+        column = bytearray(count * size)
+
+        for lane in range(size):
+            column[lane::size] = frames[offset + lane::FRAME_SIZE]
+
+        values = getattr(columns, name)
+        values.frombytes(column)
+
+        if size > 1 and sys.byteorder != 'little':
+            values.byteswap()
+
+    return columns
+
+def encode_frames(columns: FrameColumns) -> bytes:
+    """Encode columns into frames in the format of a bancho `ReplayFrameBundle`"""
+    count = len(columns)
+    frames = bytearray(count * FRAME_SIZE)
+    view = memoryview(frames)
+
+    for name, (offset, size, typecode) in FRAME_LAYOUT.items():
+        values = getattr(columns, name)
+
+        if len(values) != count:
+            # Column was not provided, e.g. the legacy byte
+            continue
+
+        if values.typecode != typecode:
+            values = array(typecode, values)
+
+        if size > 1 and sys.byteorder != 'little':
+            values = array(typecode, values)
+            values.byteswap()
+
+        column = memoryview(values).cast('B')
+
+        for lane in range(size):
+            view[offset + lane::FRAME_SIZE] = column[lane::size]
+
+    return bytes(frames)
+
+def decode_replay_frames(data: str | bytes) -> ReplayFrameColumns:
+    """Decode the decompressed frame data of an .osr file into columns
+
+    NOTE: Times are kept as deltas to the previous frame, like inside of the replay.
+    """
+    if isinstance(data, (bytes, bytearray)):
+        data = data.decode()
+
+    values = data.strip(',').replace('|', ',').split(',')
+    values = values[:len(values) - len(values) % 4]
+    seed = None
+
+    if len(values) < 4:
+        return ReplayFrameColumns()
+
+    if int(values[-4]) == SEED_FRAME_TIME:
+        seed = int(values[-1])
+        values = values[:-4]
+
+    return ReplayFrameColumns(
+        time=array('i', map(int, values[0::4])),
+        mouse_x=array('f', map(float, values[1::4])),
+        mouse_y=array('f', map(float, values[2::4])),
+        button_state=array('B', map(int, values[3::4])),
+        legacy_byte=array('B', bytes(len(values) // 4)),
+        seed=seed
+    )
+
+def encode_replay_frames(columns: FrameColumns) -> bytes:
+    """Encode columns into the uncompressed frame data of an .osr file"""
+    frames = ','.join(map(
+        '{}|{:.7g}|{:.7g}|{}'.format,
+        columns.time,
+        columns.mouse_x,
+        columns.mouse_y,
+        columns.button_state
+    ))
+
+    if getattr(columns, 'seed', None) is not None:
+        frames += f',{SEED_FRAME_TIME}|0|0|{columns.seed}'
+
+    return frames.encode()
 
 def compute_score_checksum(score: DBScore) -> str:
+    return compute_checksum(score, score.beatmap.md5, score.user.name)
+
+def compute_checksum(score, beatmap_md5: str, username: str) -> str:
+    """Compute the score checksum from any object with the columns of a score"""
     return hashlib.md5(
         '{}p{}o{}o{}t{}a{}r{}e{}y{}o{}u{}{}{}'.format(
             (score.n100 + score.n300),
@@ -12,10 +181,10 @@ def compute_score_checksum(score: DBScore) -> str:
             score.nGeki,
             score.nKatu,
             score.nMiss,
-            score.beatmap.md5,
+            beatmap_md5,
             score.max_combo,
             score.perfect,
-            score.user.name,
+            username,
             score.total_score,
             score.grade,
             score.mods,
@@ -32,3 +201,77 @@ def decode_ticks(ticks: int) -> datetime:
         datetime.datetime(1, 1, 1) +
         datetime.timedelta(microseconds=ticks // 10)
     )
+
+def encode_score_frame(stream: StreamOut, frame: bScoreFrame) -> None:
+    ScoreFrameSchema.encode(stream, frame)
+
+def encode_frame_bundle(stream: StreamOut, bundle: bReplayFrameBundle) -> None:
+    stream.s32(bundle.extra)
+    stream.u16(len(bundle.frames))
+
+    for frame in bundle.frames:
+        stream.pack(
+            FRAME,
+            frame.button_state,
+            frame.legacy_byte,
+            frame.mouse_x,
+            frame.mouse_y,
+            frame.time
+        )
+
+    stream.u8(bundle.action)
+
+    if bundle.score_frame:
+        encode_score_frame(stream, bundle.score_frame)
+
+def encode_packet(
+    packet: Enum,
+    bundle: bReplayFrameBundle | bScoreFrame,
+    legacy_header: bool = False
+) -> EncodedPacket:
+    """Serialize a frame bundle or score frame once, so that the result can be
+    sent to every spectator, instead of encoding it again for each of them.
+    """
+    header_size = 6 if legacy_header else 7
+    stream = StreamOut()
+    stream.seek(header_size)
+
+    if isinstance(bundle, bScoreFrame):
+        encode_score_frame(stream, bundle)
+    else:
+        encode_frame_bundle(stream, bundle)
+
+    payload_size = stream.size() - header_size
+    stream.seek(0)
+
+    if legacy_header:
+        stream.legacy_header(packet, payload_size)
+    else:
+        stream.header(packet, payload_size)
+
+    return EncodedPacket(packet, stream.get(), header_size)
+
+def benchmark_broadcast(
+    packet: Enum,
+    bundle: bReplayFrameBundle,
+    spectators: int = 50,
+    iterations: int = 1000
+) -> Dict[str, float]:
+    """Compare encoding a frame bundle for every spectator against encoding it once
+
+    `returns`: Dict[method, broadcasts per second]
+    """
+    def encode_per_spectator():
+        for _ in range(spectators):
+            encode_packet(packet, bundle).data
+
+    def encode_once():
+        encoded = encode_packet(packet, bundle)
+
+        for _ in range(spectators):
+            encoded.data
+
+    return {
+        'per_spectator': iterations / timeit.timeit(encode_per_spectator, number=iterations),
+        'once': iterations / timeit.timeit(encode_once, number=iterations)
+    }
@@ -28,3 +28,5 @@ from .spectator import (
     ReplayFrame as bReplayFrame,
     ScoreFrame as bScoreFrame
 )
+
+from . import schemas
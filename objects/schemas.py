@@ -0,0 +1,26 @@
+
+from ..schemas import Schema, Nested, U8, U16, U32, S32, S64, F32, STRING
+from .player import StatusUpdate, UserStats
+from .spectator import ScoreFrame
+
+ScoreFrameSchema = Schema(ScoreFrame)
+
+StatusUpdateSchema = Schema(StatusUpdate, [
+    ('action', U8),
+    ('text', STRING),
+    ('beatmap_checksum', STRING),
+    ('mods', U32),
+    ('mode', U8),
+    ('beatmap_id', S32)
+])
+
+UserStatsSchema = Schema(UserStats, [
+    ('user_id', S32),
+    ('status', Nested(StatusUpdateSchema)),
+    ('rscore', S64),
+    ('accuracy', F32),
+    ('playcount', S32),
+    ('tscore', S64),
+    ('rank', S32),
+    ('pp', U16)
+])
@@ -10,24 +10,26 @@ from ..constants import (
     Mods
 )
 
+from ..schemas import s32, u16, u8, boolean
+
 import hashlib
 
 @dataclass(slots=True)
 class ScoreFrame:
-    time: int
-    id: int
-    c300: int
-    c100: int
-    c50: int
-    cGeki: int
-    cKatu: int
-    cMiss: int
-    total_score: int
-    max_combo: int
-    current_combo: int
-    perfect: bool
-    hp: int
-    tag_byte: int = 0
+    time: s32
+    id: u8
+    c300: u16
+    c100: u16
+    c50: u16
+    cGeki: u16
+    cKatu: u16
+    cMiss: u16
+    total_score: s32
+    max_combo: u16
+    current_combo: u16
+    perfect: boolean
+    hp: u8
+    tag_byte: u8 = 0
 
     @property
     def checksum(self) -> str:
@@ -0,0 +1,219 @@
+
+from __future__ import annotations
+
+from typing import Annotated, Any, Callable, List, Tuple, get_type_hints, get_origin, get_args
+from dataclasses import fields as dataclass_fields, is_dataclass
+from enum import Enum
+
+from .streams import StreamIn, StreamOut
+
+import struct
+
+class Primitive:
+    """Fixed-width field, that can be merged with its neighbours into one struct"""
+
+    def __init__(self, format: str) -> None:
+        self.format = format
+
+class String:
+    """uleb128 prefixed string, as written by `StreamOut.string`"""
+
+class IntList:
+    """s16 prefixed list of s32 integers, as written by `StreamOut.intlist`"""
+
+class Nested:
+    """Field that is encoded with another schema"""
+
+    def __init__(self, schema: Schema) -> None:
+        self.schema = schema
+
+U8 = Primitive('B')
+U16 = Primitive('H')
+U32 = Primitive('I')
+U64 = Primitive('Q')
+S8 = Primitive('b')
+S16 = Primitive('h')
+S32 = Primitive('i')
+S64 = Primitive('q')
+F32 = Primitive('f')
+F64 = Primitive('d')
+BOOL = Primitive('?')
+STRING = String()
+INTLIST = IntList()
+
+u8 = Annotated[int, U8]
+u16 = Annotated[int, U16]
+u32 = Annotated[int, U32]
+u64 = Annotated[int, U64]
+s8 = Annotated[int, S8]
+s16 = Annotated[int, S16]
+s32 = Annotated[int, S32]
+s64 = Annotated[int, S64]
+f32 = Annotated[float, F32]
+f64 = Annotated[float, F64]
+boolean = Annotated[bool, BOOL]
+string = Annotated[str, STRING]
+intlist = Annotated[List[int], INTLIST]
+
+Layout = List[Tuple[str, Any]]
+
+class Schema:
+    """Compiles the layout of a dataclass into a codec for streams.
+
+    Contiguous fixed-width fields are merged into a single `struct.Struct`,
+    so that they can be packed & unpacked with one call. The layout is either
+    taken from `Annotated` field types (e.g. `u16` or `Annotated[Mods, U32]`)
+    in declaration order, or can be passed explicitly, if the wire order
+    differs from the order of the dataclass fields.
+    """
+
+    def __init__(
+        self,
+        cls: type,
+        layout: Layout | None = None,
+        endian: str = '<'
+    ) -> None:
+        if not is_dataclass(cls):
+            raise TypeError(f'"{cls.__name__}" is not a dataclass')
+
+        self.cls = cls
+        self.endian = endian
+        self.types = get_type_hints(cls)
+        self.layout = layout or self.layout_from_annotations(cls)
+        self.decoders: List[Callable[[StreamIn, dict], None]] = []
+        self.encoders: List[Callable[[StreamOut, Any], None]] = []
+        self.compile()
+
+    def decode(self, stream: StreamIn) -> Any:
+        values = {}
+
+        for decoder in self.decoders:
+            decoder(stream, values)
+
+        return self.cls(**values)
+
+    def encode(self, stream: StreamOut, obj: Any) -> None:
+        for encoder in self.encoders:
+            encoder(stream, obj)
+
+    def loads(self, data: bytes) -> Any:
+        return self.decode(StreamIn(data, self.endian, zero_copy=True))
+
+    def dumps(self, obj: Any) -> bytes:
+        stream = StreamOut(self.endian)
+        self.encode(stream, obj)
+        return stream.get()
+
+    @staticmethod
+    def layout_from_annotations(cls: type) -> Layout:
+        hints = get_type_hints(cls, include_extras=True)
+        layout = []
+
+        for field in dataclass_fields(cls):
+            hint = hints[field.name]
+
+            if get_origin(hint) is not Annotated:
+                raise TypeError(f'Field "{field.name}" has no wire type')
+
+            layout.append((field.name, get_args(hint)[1]))
+
+        return layout
+
+    def compile(self) -> None:
+        run: Layout = []
+
+        for name, kind in self.layout:
+            if isinstance(kind, Primitive):
+                run.append((name, kind))
+                continue
+
+            if run:
+                self.compile_run(run)
+                run = []
+
+            if isinstance(kind, String):
+                self.compile_string(name)
+
+            elif isinstance(kind, IntList):
+                self.compile_intlist(name)
+
+            elif isinstance(kind, Nested):
+                self.compile_nested(name, kind.schema)
+
+            else:
+                raise TypeError(f'Unsupported wire type for "{name}": {kind}')
+
+        if run:
+            self.compile_run(run)
+
+    def compile_run(self, run: Layout) -> None:
+        format = struct.Struct(
+            self.endian + ''.join(kind.format for _, kind in run)
+        )
+        names = [name for name, _ in run]
+        enums = [
+            (index, self.types[name])
+            for index, name in enumerate(names)
+            if isinstance(self.types[name], type)
+            and issubclass(self.types[name], Enum)
+        ]
+
+        def decode(stream: StreamIn, values: dict) -> None:
+            if stream.available() < format.size:
+                raise OverflowError('Buffer overflow')
+
+            unpacked = list(format.unpack_from(stream.data, stream.pos))
+            stream.pos += format.size
+
+            for index, enum in enums:
+                unpacked[index] = enum(unpacked[index])
+
+            values.update(zip(names, unpacked))
+
+        def encode(stream: StreamOut, obj: Any) -> None:
+            values = [getattr(obj, name) for name in names]
+
+            for index, _ in enums:
+                values[index] = values[index].value
+
+            stream.pack(format, *values)
+
+        self.decoders.append(decode)
+        self.encoders.append(encode)
+
+    def compile_string(self, name: str) -> None:
+        def decode(stream: StreamIn, values: dict) -> None:
+            values[name] = stream.string()
+
+        def encode(stream: StreamOut, obj: Any) -> None:
+            stream.string(getattr(obj, name))
+
+        self.decoders.append(decode)
+        self.encoders.append(encode)
+
+    def compile_intlist(self, name: str) -> None:
+        def decode(stream: StreamIn, values: dict) -> None:
+            count = stream.s16()
+            format = struct.Struct(f'{self.endian}{count}i')
+
+            if stream.available() < format.size:
+                raise OverflowError('Buffer overflow')
+
+            values[name] = list(format.unpack_from(stream.data, stream.pos))
+            stream.pos += format.size
+
+        def encode(stream: StreamOut, obj: Any) -> None:
+            stream.intlist(getattr(obj, name))
+
+        self.decoders.append(decode)
+        self.encoders.append(encode)
+
+    def compile_nested(self, name: str, schema: Schema) -> None:
+        def decode(stream: StreamIn, values: dict) -> None:
+            values[name] = schema.decode(stream)
+
+        def encode(stream: StreamOut, obj: Any) -> None:
+            schema.encode(stream, getattr(obj, name))
+
+        self.decoders.append(decode)
+        self.encoders.append(encode)
@@ -3,30 +3,202 @@ from __future__ import annotations
 
 from boto3_type_annotations.s3 import Client
 from botocore.exceptions import ClientError
+from botocore.config import Config
 from sqlalchemy.orm import Session
-from typing import List, Dict
+from concurrent.futures import ThreadPoolExecutor, Future, FIRST_COMPLETED, as_completed, wait
+from typing import BinaryIO, Callable, Iterable, Iterator, Tuple, Union, List, Dict
 
 from datetime import timedelta
 from redis import Redis
 
 from .database.repositories import scores, wrapper
 from .helpers.external import Beatmaps
+from .helpers.caching import SingleFlight, LocalCache
 from .streams import StreamOut
-from .helpers import replays
+from .helpers import compression, replays
 
+import itertools
 import hashlib
 import logging
+import time
 import config
 import boto3
 import app
 import os
 import io
 
+Content = Union[bytes, BinaryIO, Iterable[bytes]]
+
+# Names of the cached copies of an object, by bucket
+CACHE_NAMES: Dict[str, Callable[[str], Tuple[str, ...]]] = {
+    'avatars': lambda key: (f'avatar:{key}',),
+    'screenshots': lambda key: (f'screenshot:{key}',),
+    'replays': lambda key: (f'osr:{key}', f'osr:full:{key}'),
+    'beatmaps': lambda key: (f'osu:{key}',),
+    'thumbnails': lambda key: (f'mt:{key}', f'mt:{key}l'),
+    'audio': lambda key: (f'mp3:{key}',),
+    'osz': lambda key: (f'osz:{key}',),
+    'osz2': lambda key: (f'osz2:{key}',),
+    'release': lambda key: (f'release:{key}',)
+}
+
+def is_not_found(error: ClientError) -> bool:
+    """Check if a client error means that the object doesn't exist"""
+    return error.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound')
+
+# KEYS: lock
+# ARGV: token
+RELEASE_LOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+
+return 0
+"""
+
+# KEYS: version, fresh, followed by pairs of index & rebuilt index
+# ARGV: version at the start of the rebuild, fresh expiry (ms)
+SWAP_HASHES_SCRIPT = """
+if tonumber(redis.call('GET', KEYS[1]) or 0) ~= tonumber(ARGV[1]) then
+    -- The index was updated during the rebuild, which makes the rebuilt index outdated
+    for i = 4, #KEYS, 2 do
+        redis.call('DEL', KEYS[i])
+    end
+    return 0
+end
+
+for i = 3, #KEYS, 2 do
+    if redis.call('EXISTS', KEYS[i + 1]) == 1 then
+        redis.call('RENAME', KEYS[i + 1], KEYS[i])
+        redis.call('PERSIST', KEYS[i])
+    else
+        redis.call('DEL', KEYS[i])
+    end
+end
+
+redis.call('SET', KEYS[2], 1, 'PX', ARGV[2])
+return 1
+"""
+
+def iter_parts(content: Content, part_size: int) -> Iterator[bytes]:
+    """Split bytes, file-like objects or chunk iterators into parts of `part_size`"""
+    if isinstance(content, (bytes, bytearray, memoryview)):
+        view = memoryview(content)
+
+        for offset in range(0, len(view), part_size):
+            yield view[offset:offset + part_size]
+
+        return
+
+    if hasattr(content, 'read'):
+        # Raw & network streams can return less than requested,
+        # so their reads need to be buffered up to the part size
+        read = content.read
+        content = iter(lambda: read(part_size), b'')
+
+    buffer = bytearray()
+
+    for chunk in content:
+        if not buffer and len(chunk) == part_size:
+            yield chunk
+            continue
+
+        buffer += chunk
+
+        while len(buffer) >= part_size:
+            yield bytes(buffer[:part_size])
+            del buffer[:part_size]
+
+    if buffer:
+        yield bytes(buffer)
+
+class StoredObject:
+    """File-like handle for reading an object, or a byte range of it, in chunks"""
+
+    def __init__(self, stream: BinaryIO, start: int, end: int, total_size: int) -> None:
+        self.stream = stream
+        self.start = start
+        self.end = end
+        self.total_size = total_size
+        self.remaining = self.size
+
+    @property
+    def size(self) -> int:
+        return self.end - self.start + 1
+
+    @property
+    def partial(self) -> bool:
+        return self.size != self.total_size
+
+    @property
+    def content_range(self) -> str:
+        return f'bytes {self.start}-{self.end}/{self.total_size}'
+
+    def fileno(self) -> int:
+        """Get the file descriptor of local files, e.g. for use with `os.sendfile`"""
+        return self.stream.fileno()
+
+    def read(self, size: int = -1) -> bytes:
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+
+        data = self.stream.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def iter_chunks(self, chunk_size: int = 1024 * 64) -> Iterator[bytes]:
+        try:
+            while (chunk := self.read(chunk_size)):
+                yield chunk
+        finally:
+            self.close()
+
+    def close(self) -> None:
+        self.stream.close()
+
+    def __iter__(self) -> Iterator[bytes]:
+        return self.iter_chunks()
+
+    def __enter__(self) -> StoredObject:
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
 class Storage:
     """This class aims to provide a higher level api for using/managing storage."""
 
-    def __init__(self) -> None:
+    def __init__(
+        self,
+        distributed_locks: bool = False,
+        lock_timeout: timedelta = timedelta(seconds=30),
+        missing_expiry: timedelta | None = timedelta(minutes=1),
+        local_cache_size: int = 0,
+        local_cache_ttl: timedelta = timedelta(seconds=30),
+        part_size: int = 8 * 1024 * 1024,
+        upload_concurrency: int = 4,
+        part_retries: int = 3,
+        transfer_workers: int = 16,
+        hash_index_expiry: timedelta = timedelta(days=1),
+        compression_codecs: Dict[str, str] | None = None
+    ) -> None:
         self.logger = logging.getLogger('storage')
+        self.flight = SingleFlight()
+        self.distributed_locks = distributed_locks
+        self.lock_timeout = lock_timeout
+        self.missing_expiry = missing_expiry
+
+        # Settings for multipart uploads, where part_size * upload_concurrency
+        # is the maximum amount of memory used for buffering a single upload
+        self.part_size = max(part_size, 5 * 1024 * 1024)
+        self.upload_concurrency = upload_concurrency
+        self.part_retries = part_retries
+        self.transfer_workers = transfer_workers
+        self.hash_index_expiry = hash_index_expiry
+
+        # Compression codecs for cached objects, by their key prefix. Images, audio
+        # and replays (lzma) are already compressed, and are stored as they are.
+        self.compression_codecs = compression_codecs or {'osu': 'zlib'}
 
         self.cache = Redis(
             config.REDIS_HOST,
@@ -37,68 +209,64 @@ class Storage:
             's3',
             endpoint_url=config.S3_BASEURL,
             aws_access_key_id=config.S3_ACCESS_KEY,
-            aws_secret_access_key=config.S3_SECRET_KEY
+            aws_secret_access_key=config.S3_SECRET_KEY,
+            config=Config(
+                # Enough connections for bulk transfers & multipart uploads to share the client
+                max_pool_connections=max(10, transfer_workers + upload_concurrency),
+                retries={'max_attempts': 5, 'mode': 'adaptive'}
+            )
         )
 
         self.api = Beatmaps()
+        self.release_lock = self.cache.register_script(RELEASE_LOCK_SCRIPT)
+        self.swap_hashes = self.cache.register_script(SWAP_HASHES_SCRIPT)
 
-    def get_avatar(self, id: str) -> bytes | None:
-        if (image := self.get_from_cache(f'avatar:{id}')):
-            return image
+        # Optional in-process cache for hot objects, which gets
+        # invalidated through pubsub when objects are overwritten
+        self.local: LocalCache | None = None
 
-        if config.S3_ENABLED:
-            if not (image := self.get_from_s3(str(id), 'avatars')):
-                return
-
-        else:
-            if not (image := self.get_file_content(f'/avatars/{id}')):
-                return
+        if local_cache_size > 0:
+            self.local = LocalCache(
+                local_cache_size,
+                local_cache_ttl.total_seconds()
+            )
+            self.invalidations = self.cache.pubsub(ignore_subscribe_messages=True)
+            self.invalidations.subscribe(**{'storage:invalidate': self.on_invalidate})
+            self.invalidations.run_in_thread(sleep_time=1, daemon=True)
 
-        self.save_to_cache(
+    def get_avatar(self, id: str) -> bytes | None:
+        return self.get_cached(
             name=f'avatar:{id}',
-            content=image,
+            fetch=lambda: self.get_internal(str(id), 'avatars', missing_ok=False),
             expiry=timedelta(days=1)
         )
 
-        return image
-    
     def get_screenshot(self, id: int) -> bytes | None:
-        if config.S3_ENABLED:
-            if not (image := self.get_from_s3(str(id), 'screenshots')):
-                return
-
-        else:
-            if not (image := self.get_file_content(f'/screenshots/{id}')):
-                return
+        return self.get_cached(
+            name=f'screenshot:{id}',
+            fetch=lambda: self.get_internal(str(id), 'screenshots', missing_ok=False)
+        )
 
-        return image
-    
     def get_replay(self, id: int) -> bytes | None:
-        if (replay := self.get_from_cache(f'osr:{id}')):
-            return replay
-
-        if config.S3_ENABLED:
-            if not (replay := self.get_from_s3(str(id), 'replays')):
-                return
-
-        else:
-            if not (replay := self.get_file_content(f'/replays/{id}')):
-                return
-
-        self.save_to_cache(
+        return self.get_cached(
             name=f'osr:{id}',
-            content=replay,
+            fetch=lambda: self.get_internal(str(id), 'replays', missing_ok=False),
             expiry=timedelta(hours=1)
         )
 
-        return replay
-    
+    def get_full_replay(self, id: int) -> bytes | None:
+        if (replay := self.get_from_cache(f'osr:full:{id}')):
+            return replay
+
+        # Only open a database session on a cache miss
+        return self.build_full_replay(id)
+
     @wrapper.session_wrapper
-    def get_full_replay(self, id: int, session: Session = ...) -> bytes | None:
+    def build_full_replay(self, id: int, session: Session = ...) -> bytes | None:
         if not (replay := self.get_replay(id)):
             return
 
-        score = scores.fetch_by_id(id, session=session)
+        score = scores.fetch_replay_header(id, session=session)
 
         if not score:
             return
@@ -106,9 +274,9 @@ class Storage:
         stream = StreamOut()
         stream.u8(score.mode)
         stream.s32(score.client_version)
-        stream.string(score.beatmap.md5)
-        stream.string(score.user.name)
-        stream.string(replays.compute_score_checksum(score))
+        stream.string(score.beatmap_md5)
+        stream.string(score.username)
+        stream.string(replays.compute_checksum(score, score.beatmap_md5, score.username))
         stream.u16(score.n300)
         stream.u16(score.n100)
         stream.u16(score.n50)
@@ -125,136 +293,228 @@ class Storage:
         stream.write(replay)
         stream.s32(score.id)
 
-        return stream.get()
+        self.save_to_cache(
+            name=f'osr:full:{id}',
+            content=(full_replay := stream.get()),
+            expiry=timedelta(hours=1)
+        )
+
+        return full_replay
 
     def get_osz(self, set_id: int) -> bytes | None:
         return self.api.osz(set_id)
 
     def get_osz_internal(self, set_id: int) -> bytes | None:
-        if config.S3_ENABLED:
-            osz = self.get_from_s3(str(set_id), 'osz')
-
-        else:
-            osz = self.get_file_content(f'/osz/{set_id}')
-
-        if not osz:
-            return
-
-        return osz
+        return self.get_cached(
+            name=f'osz:{set_id}',
+            fetch=lambda: self.get_internal(str(set_id), 'osz', missing_ok=False)
+        )
 
     def get_osz2_internal(self, set_id: int) -> bytes | None:
-        if config.S3_ENABLED:
-            osz = self.get_from_s3(str(set_id), 'osz2')
-
-        else:
-            osz = self.get_file_content(f'/osz2/{set_id}')
-
-        if not osz:
-            return
-
-        return osz
+        return self.get_cached(
+            name=f'osz2:{set_id}',
+            fetch=lambda: self.get_internal(str(set_id), 'osz2', missing_ok=False)
+        )
 
     def get_beatmap(self, id: int) -> bytes | None:
         return self.api.osu(id)
 
     def get_beatmap_internal(self, id: int) -> bytes | None:
-        if (osu := self.get_from_cache(f'osu:{id}')):
-            return osu
-
-        if config.S3_ENABLED:
-            osu = self.get_from_s3(str(id), 'beatmaps')
-
-        else:
-            osu = self.get_file_content(f'/beatmaps/{id}')
-
-        if not osu:
-            return
-
-        return osu
+        return self.get_cached(
+            name=f'osu:{id}',
+            fetch=lambda: self.get_internal(str(id), 'beatmaps', missing_ok=False)
+        )
 
     def get_background(self, id: str) -> bytes | None:
-        if (image := self.get_from_cache(f'mt:{id}')):
-            return image
-
         if not (id.replace('l', '')).isdigit():
             return
 
         set_id = int(id.replace('l', ''))
         large = 'l' in id
 
-        if not (image := self.api.background(set_id, large)):
-            return
-
-        self.save_to_cache(
+        return self.get_cached(
             name=f'mt:{id}',
-            content=image,
+            fetch=lambda: self.api.background(set_id, large),
             expiry=timedelta(weeks=3)
         )
 
-        return image
-
     def get_background_internal(self, set_id: int) -> bytes | None:
-        if (image := self.get_from_cache(f'mt:{set_id}l')):
-            return image
-
-        if config.S3_ENABLED:
-            image = self.get_from_s3(str(set_id), 'thumbnails')
-
-        else:
-            image = self.get_file_content(f'/thumbnails/{set_id}')
-
-        if not image:
-            return
-
-        self.save_to_cache(
+        return self.get_cached(
             name=f'mt:{set_id}l',
-            content=image,
+            fetch=lambda: self.get_internal(str(set_id), 'thumbnails', missing_ok=False),
             expiry=timedelta(weeks=3)
         )
 
-        return image
-
     def get_mp3(self, set_id: int) -> bytes | None:
-        if (mp3 := self.get_from_cache(f'mp3:{set_id}')):
-            return mp3
-
-        if not (mp3 := self.api.preview(set_id)):
-            return
+        return self.get_cached(
+            name=f'mp3:{set_id}',
+            fetch=lambda: self.api.preview(set_id),
+            expiry=timedelta(hours=1)
+        )
 
-        self.save_to_cache(
+    def get_mp3_internal(self, set_id: int) -> bytes | None:
+        return self.get_cached(
             name=f'mp3:{set_id}',
-            content=mp3,
+            fetch=lambda: self.get_internal(str(set_id), 'audio', missing_ok=False),
             expiry=timedelta(hours=1)
         )
 
-        return mp3
+    def get_release_file(self, filename: str) -> bytes | None:
+        return self.get_cached(
+            name=f'release:{filename}',
+            fetch=lambda: self.get_internal(filename, 'release', missing_ok=False)
+        )
 
-    def get_mp3_internal(self, set_id: int) -> bytes | None:
-        if (mp3 := self.get_from_cache(f'mp3:{set_id}')):
-            return mp3
+    def open_osz(self, set_id: int, start: int = 0, end: int | None = None) -> StoredObject | None:
+        return self.open_internal(str(set_id), 'osz', start, end)
+
+    def open_osz2(self, set_id: int, start: int = 0, end: int | None = None) -> StoredObject | None:
+        return self.open_internal(str(set_id), 'osz2', start, end)
+
+    def open_mp3(self, set_id: int, start: int = 0, end: int | None = None) -> StoredObject | None:
+        return self.open_internal(str(set_id), 'audio', start, end)
+
+    def open_replay(self, id: int, start: int = 0, end: int | None = None) -> StoredObject | None:
+        return self.open_internal(str(id), 'replays', start, end)
 
+    def open_release_file(self, filename: str, start: int = 0, end: int | None = None) -> StoredObject | None:
+        return self.open_internal(filename, 'release', start, end)
+
+    def open_internal(
+        self,
+        key: str,
+        bucket: str,
+        start: int = 0,
+        end: int | None = None
+    ) -> StoredObject | None:
+        """Open an object from s3 or the local data directory, without reading it into memory.
+
+        `start` and `end` select an inclusive byte range, like the http range header.
+        Returns None if the object does not exist, or the range cannot be satisfied.
+        """
         if config.S3_ENABLED:
-            mp3 = self.get_from_s3(str(set_id), 'audio')
+            return self.open_from_s3(key, bucket, start, end)
 
-        else:
-            mp3 = self.get_file_content(f'/audio/{set_id}')
+        return self.open_file(f'/{bucket}/{key}', start, end)
+
+    def get_internal(self, key: str, bucket: str, missing_ok: bool = True) -> bytes | None:
+        """Get an object from s3 or the local data directory.
+
+        Returns None if the object could not be read. With `missing_ok` disabled,
+        objects that are confirmed to not exist raise a FileNotFoundError instead.
+        """
+        if config.S3_ENABLED:
+            return self.get_from_s3(key, bucket, missing_ok)
+
+        return self.get_file_content(f'/{bucket}/{key}', missing_ok)
+
+    def get_cached(
+        self,
+        name: str,
+        fetch: Callable[[], bytes | None],
+        expiry: timedelta | None = None
+    ) -> bytes | None:
+        """Get an object from the cache, or fetch it on a cache miss.
+
+        Only one fetch per object will be in flight inside of this process,
+        and concurrent callers will wait for its result. With `distributed_locks`
+        enabled, this is extended across processes through a redis lock.
+        Objects that could not be found, i.e. where `fetch` raised a FileNotFoundError,
+        are remembered for `missing_expiry`. Other failures are not remembered.
+        """
+        if self.local and (content := self.local.get(name)):
+            return content
+
+        content, missing = self.cache.mget(name, f'missing:{name}')
+
+        if content:
+            content = compression.decompress(content)
+
+            if self.local:
+                self.local.set(name, content)
+            return content
 
-        if not mp3:
+        if missing:
             return
 
-        self.save_to_cache(
-            name=f'mp3:{set_id}',
-            content=mp3,
-            expiry=timedelta(hours=1)
+        return self.flight.do(
+            name,
+            lambda: self.fetch_and_cache(name, fetch, expiry)
         )
 
-        return mp3
+    def fetch_and_cache(
+        self,
+        name: str,
+        fetch: Callable[[], bytes | None],
+        expiry: timedelta | None = None
+    ) -> bytes | None:
+        if not self.distributed_locks or expiry is None:
+            # Objects that don't get cached can't be shared with other processes
+            return self.fetch_to_cache(name, fetch, expiry)
 
-    def get_release_file(self, filename: str) -> bytes | None:
-        if config.S3_ENABLED:
-            return self.get_from_s3(filename, 'release')
-        else:
-            return self.get_file_content(f'/release/{filename}')
+        lock = f'lock:{name}'
+        token = os.urandom(16).hex()
+        timeout = self.lock_timeout.total_seconds()
+
+        if self.cache.set(lock, token, px=int(timeout * 1000), nx=True):
+            try:
+                return self.fetch_to_cache(name, fetch, expiry)
+            finally:
+                # Only release the lock if it wasn't taken over after a timeout
+                self.release_lock(keys=[lock], args=[token])
+
+        # Another process is fetching this object, wait for
+        # it to show up in the cache, or to be marked as missing
+        deadline = time.monotonic() + timeout
+
+        while time.monotonic() < deadline:
+            time.sleep(0.05)
+
+            content, missing, locked = self.cache.mget(name, f'missing:{name}', lock)
+
+            if content:
+                content = compression.decompress(content)
+
+                if self.local:
+                    self.local.set(name, content)
+                return content
+
+            if missing:
+                return
+
+            if not locked:
+                break
+
+        return self.fetch_to_cache(name, fetch, expiry)
+
+    def fetch_to_cache(
+        self,
+        name: str,
+        fetch: Callable[[], bytes | None],
+        expiry: timedelta | None = None
+    ) -> bytes | None:
+        try:
+            content = fetch()
+        except FileNotFoundError:
+            if self.missing_expiry is not None:
+                self.cache.set(f'missing:{name}', 1, self.missing_expiry)
+            return
+
+        if not content:
+            # The fetch failed, e.g. because of throttling, which is retried on the next request
+            return
+
+        if expiry is not None:
+            self.save_to_cache(
+                name=name,
+                content=content,
+                expiry=expiry
+            )
+
+            if self.local:
+                self.local.set(name, content)
+
+        return content
 
     def upload_avatar(self, id: int, content: bytes):
         if config.S3_ENABLED:
@@ -269,25 +529,36 @@ class Storage:
             expiry=timedelta(weeks=1)
         )
 
+        self.invalidate(f'avatar:{id}')
+
     def upload_screenshot(self, id: int, content: bytes):
         if config.S3_ENABLED:
             self.save_to_s3(content, str(id), 'screenshots')
 
         else:
             self.save_to_file(f'/screenshots/{id}', content)
-    
-    def upload_replay(self, id: int, content: bytes):
+
+        self.invalidate(f'screenshot:{id}')
+
+    def upload_replay(self, id: int, content: Content):
         if config.S3_ENABLED:
             self.save_to_s3(content, str(id), 'replays')
 
         else:
             self.save_to_file(f'/replays/{id}', content)
 
-        self.save_to_cache(
-            name=f'osr:{id}',
-            content=content,
-            expiry=timedelta(days=1)
-        )
+        self.remove_from_cache(f'osr:full:{id}')
+
+        if isinstance(content, bytes):
+            self.save_to_cache(
+                name=f'osr:{id}',
+                content=content,
+                expiry=timedelta(days=1)
+            )
+        else:
+            self.remove_from_cache(f'osr:{id}')
+
+        self.invalidate(f'osr:{id}')
 
     def upload_beatmap_file(self, id: int, content: bytes):
         if config.S3_ENABLED:
@@ -302,20 +573,26 @@ class Storage:
             expiry=timedelta(days=1)
         )
 
-    def upload_osz(self, set_id: int, content: bytes):
+        self.invalidate(f'osu:{id}')
+
+    def upload_osz(self, set_id: int, content: Content):
         if config.S3_ENABLED:
             self.save_to_s3(content, str(set_id), 'osz')
 
         else:
             self.save_to_file(f'/osz/{set_id}', content)
 
-    def upload_osz2(self, set_id: int, content: bytes):
+        self.invalidate(f'osz:{set_id}')
+
+    def upload_osz2(self, set_id: int, content: Content):
         if config.S3_ENABLED:
             self.save_to_s3(content, str(set_id), 'osz2')
 
         else:
             self.save_to_file(f'/osz2/{set_id}', content)
 
+        self.invalidate(f'osz2:{set_id}')
+
     def upload_background(self, set_id: int, content: bytes):
         if config.S3_ENABLED:
             self.save_to_s3(content, str(set_id), 'thumbnails')
@@ -329,6 +606,8 @@ class Storage:
             expiry=timedelta(weeks=3)
         )
 
+        self.invalidate(f'mt:{set_id}', f'mt:{set_id}l')
+
     def upload_mp3(self, set_id: int, content: bytes):
         if config.S3_ENABLED:
             self.save_to_s3(content, str(set_id), 'audio')
@@ -342,15 +621,22 @@ class Storage:
             expiry=timedelta(hours=1)
         )
 
+        self.invalidate(f'mp3:{set_id}')
+
     def cache_replay(self, id: int, content: bytes, time=timedelta(hours=1)):
+        self.remove_from_cache(f'osr:full:{id}')
         self.save_to_cache(
             name=f'osr:{id}',
             content=content,
             expiry=time
         )
 
+        self.invalidate(f'osr:{id}')
+
     def remove_replay(self, id: int):
         self.logger.debug(f'Removing replay with id "{id}"...')
+        self.remove_from_cache(f'osr:full:{id}')
+        self.remove_from_cache(f'osr:{id}')
 
         if not config.S3_ENABLED:
             return self.remove_file(f'/replays/{id}')
@@ -365,7 +651,119 @@ class Storage:
         else:
             return self.remove_from_s3('osz2', str(set_id))
 
+    def put_many(self, items: Iterable[Tuple[str, Content]], bucket: str) -> Iterator[Tuple[str, bool]]:
+        """Upload many objects concurrently, and yield whether each upload succeeded"""
+        if config.S3_ENABLED:
+            upload = lambda item: self.save_to_s3(item[1], item[0], bucket)
+        else:
+            upload = lambda item: self.save_to_file(f'/{bucket}/{item[0]}', item[1])
+
+        for (key, _), success in self.run_bounded(upload, items):
+            if success:
+                self.evict(bucket, key)
+
+            yield key, success
+
+    def get_many(self, keys: Iterable[str], bucket: str) -> Iterator[Tuple[str, bytes | None]]:
+        """Download many objects concurrently, and yield them as they finish (None if missing)"""
+        return self.run_bounded(
+            lambda key: self.get_internal(key, bucket),
+            keys
+        )
+
+    def delete_many(self, keys: Iterable[str], bucket: str) -> Iterator[Tuple[str, bool]]:
+        """Remove many objects, in batches of 1000 keys per request on s3, and yield the result of each"""
+        if not config.S3_ENABLED:
+            for key, success in self.run_bounded(
+                lambda key: self.remove_file(f'/{bucket}/{key}'),
+                keys
+            ):
+                if success:
+                    self.evict(bucket, key)
+
+                yield key, success
+            return
+
+        keys = iter(keys)
+        batches = iter(lambda: list(itertools.islice(keys, 1000)), [])
+
+        for _, results in self.run_bounded(
+            lambda batch: self.delete_batch_from_s3(batch, bucket),
+            batches
+        ):
+            self.evict(bucket, *(key for key, success in results.items() if success))
+            yield from results.items()
+
+    def delete_batch_from_s3(self, keys: List[str], bucket: str) -> Dict[str, bool]:
+        try:
+            response = self.s3.delete_objects(
+                Bucket=bucket,
+                Delete={
+                    'Objects': [{'Key': key} for key in keys],
+                    'Quiet': True
+                }
+            )
+        except Exception as e:
+            self.logger.error(f'Failed to remove {len(keys)} objects from {bucket}: "{e}"')
+            return {key: False for key in keys}
+
+        results = {key: True for key in keys}
+
+        for error in response.get('Errors', []):
+            self.logger.warning(
+                f'Failed to remove "{error["Key"]}" from {bucket}: "{error.get("Message")}"'
+            )
+            results[error['Key']] = False
+
+        self.unindex_file_hashes(bucket, *(key for key, success in results.items() if success))
+        return results
+
+    def run_bounded(self, func: Callable, items: Iterable) -> Iterator[Tuple]:
+        """Run `func` for every item on the transfer pool, and yield the items with their results.
+
+        Only a limited amount of items is submitted at once, so that
+        large iterators are not buffered into memory as a whole.
+        """
+        max_pending = self.transfer_workers * 2
+        pending: Dict[Future, object] = {}
+
+        with ThreadPoolExecutor(self.transfer_workers, thread_name_prefix='storage') as pool:
+            for item in items:
+                if len(pending) >= max_pending:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+
+                    for future in done:
+                        yield pending.pop(future), future.result()
+
+                pending[pool.submit(func, item)] = item
+
+            for future in as_completed(pending):
+                yield pending[future], future.result()
+
     def get_file_hashes(self, key: str) -> Dict[str, str]:
+        """Get the hashes of all files in a bucket/directory from the hash index.
+
+        Files written or removed through this class update the index in place.
+        The index is only rebuilt if it doesn't exist, or after `hash_index_expiry`,
+        to pick up changes that were made outside of this class.
+        """
+        with self.cache.pipeline() as pipe:
+            pipe.exists(f'storage:hashes:{key}:fresh')
+            pipe.hgetall(f'storage:hashes:{key}')
+            fresh, hashes = pipe.execute()
+
+        if fresh:
+            return {
+                filename.decode(): hash.decode()
+                for filename, hash in hashes.items()
+            }
+
+        return self.flight.do(
+            f'hashes:{key}',
+            lambda: self.update_file_hashes(key)
+        )
+
+    def update_file_hashes(self, key: str) -> Dict[str, str]:
         if config.S3_ENABLED:
             return self.get_file_hashes_s3(key)
         else:
@@ -373,33 +771,57 @@ class Storage:
 
     def get_file_hashes_s3(self, bucket: str) -> Dict[str, str]:
         if not config.S3_ENABLED:
-            return []
+            return {}
+
+        version = int(self.cache.get(f'storage:hashes:{bucket}:version') or 0)
 
         try:
-            return {
+            paginator = self.s3.get_paginator('list_objects_v2')
+            hashes = {
                 object['Key']: object['ETag'].replace('"', '')
-                for object in self.s3.list_objects(Bucket=bucket)['Contents']
+                for page in paginator.paginate(Bucket=bucket)
+                for object in page.get('Contents', [])
             }
         except Exception as e:
             self.logger.error(f'Failed to get etags: {e}')
-            return []
+            return {}
+
+        self.save_file_hashes(bucket, hashes, version=version)
+        return hashes
 
     def get_file_hashes_local(self, directory: str) -> Dict[str, str]:
+        """Hash the files in a directory, where only new or changed files will be read"""
         if config.S3_ENABLED:
             return {}
 
+        with self.cache.pipeline() as pipe:
+            pipe.hgetall(f'storage:hashes:{directory}')
+            pipe.hgetall(f'storage:hashes:{directory}:stat')
+            pipe.get(f'storage:hashes:{directory}:version')
+            previous_hashes, previous_stats, version = pipe.execute()
+
+        file_hashes = {}
+        file_stats = {}
+
         try:
-            file_hashes = {}
+            for entry in os.scandir(f'{config.DATA_PATH}/{directory}'):
+                if not entry.is_file():
+                    continue
 
-            for filename in os.listdir(f'{config.DATA_PATH}/{directory}'):
                 try:
-                    with open(f'{config.DATA_PATH}/{directory}/{filename}', 'rb') as file:
-                        file_content = file.read()
-                        file_hash = hashlib.md5(file_content).hexdigest()
-                        file_hashes[filename] = file_hash
+                    signature = self.file_signature(entry.path)
+                    name = entry.name.encode()
+
+                    if previous_stats.get(name) == signature.encode() and name in previous_hashes:
+                        file_hashes[entry.name] = previous_hashes[name].decode()
+                        file_stats[entry.name] = signature
+                        continue
+
+                    file_hashes[entry.name] = self.hash_file(entry.path)
+                    file_stats[entry.name] = signature
                 except Exception as e:
                     self.logger.error(
-                        f'Failed to read file "{filename}": {e}',
+                        f'Failed to read file "{entry.name}": {e}',
                         exc_info=e
                     )
         except Exception as e:
@@ -407,9 +829,97 @@ class Storage:
                 f'Failed to list files in directory "{directory}": {e}',
                 exc_info=e
             )
+            return file_hashes
 
+        self.save_file_hashes(directory, file_hashes, file_stats, version=int(version or 0))
         return file_hashes
 
+    def save_file_hashes(
+        self,
+        key: str,
+        hashes: Dict[str, str],
+        stats: Dict[str, str] | None = None,
+        version: int = 0,
+        batch_size: int = 10000
+    ) -> bool:
+        """Replace the hash index of a bucket/directory.
+
+        The new index is built in batches under temporary keys, and then
+        swapped in with a script, so that redis isn't blocked by a large
+        transaction and readers never see a partial index. `version` is the
+        version of the index from before the files were listed. If files were
+        indexed or unindexed since then, the snapshot is discarded, and
+        the index stays as it is until the next rebuild.
+        """
+        token = os.urandom(8).hex()
+        indexes = {
+            f'storage:hashes:{key}': list(hashes.items()),
+            f'storage:hashes:{key}:stat': list((stats or {}).items())
+        }
+
+        for name, items in indexes.items():
+            for offset in range(0, len(items), batch_size):
+                with self.cache.pipeline(transaction=False) as pipe:
+                    pipe.hset(
+                        f'{name}:rebuild:{token}',
+                        mapping=dict(items[offset:offset + batch_size])
+                    )
+                    # Clean up after rebuilds that didn't finish
+                    pipe.expire(f'{name}:rebuild:{token}', timedelta(hours=1))
+                    pipe.execute()
+
+        swapped = self.swap_hashes(
+            keys=[
+                f'storage:hashes:{key}:version',
+                f'storage:hashes:{key}:fresh',
+                *(
+                    index_key
+                    for name in indexes
+                    for index_key in (name, f'{name}:rebuild:{token}')
+                )
+            ],
+            args=[version, int(self.hash_index_expiry.total_seconds() * 1000)]
+        )
+
+        if not swapped:
+            self.logger.debug(f'Hash index of "{key}" changed during the rebuild, skipping it')
+
+        return bool(swapped)
+
+    def index_file_hash(self, key: str, filename: str, hash: str, signature: str | None = None) -> None:
+        """Update the hash of a single file inside the hash index"""
+        with self.cache.pipeline(transaction=False) as pipe:
+            pipe.hset(f'storage:hashes:{key}', filename, hash)
+
+            if signature is not None:
+                pipe.hset(f'storage:hashes:{key}:stat', filename, signature)
+
+            pipe.incr(f'storage:hashes:{key}:version')
+            pipe.execute()
+
+    def unindex_file_hashes(self, key: str, *filenames: str) -> None:
+        if not filenames:
+            return
+
+        with self.cache.pipeline(transaction=False) as pipe:
+            pipe.hdel(f'storage:hashes:{key}', *filenames)
+            pipe.hdel(f'storage:hashes:{key}:stat', *filenames)
+            pipe.incr(f'storage:hashes:{key}:version')
+            pipe.execute()
+
+    def file_signature(self, path: str) -> str:
+        stat = os.stat(path)
+        return f'{stat.st_mtime_ns}:{stat.st_size}'
+
+    def hash_file(self, path: str, chunk_size: int = 1024 * 1024) -> str:
+        hash = hashlib.md5()
+
+        with open(path, 'rb') as file:
+            while (chunk := file.read(chunk_size)):
+                hash.update(chunk)
+
+        return hash.hexdigest()
+
     def get_presigned_url(self, bucket: str, key: str, expiration: int = 900) -> str | None:
         if not config.S3_ENABLED:
             return
@@ -428,31 +938,197 @@ class Storage:
             return
 
     def save_to_cache(self, name: str, content: bytes, expiry=timedelta(weeks=1), override=True) -> bool:
-        return self.cache.set(name, content, expiry, nx=(not override))
+        prefix = name.split(':')[0]
+
+        if not (codec := self.compression_codecs.get(prefix)):
+            return self.cache.set(name, content, expiry, nx=(not override))
+
+        compressed = compression.compress(content, codec)
+
+        with self.cache.pipeline(transaction=False) as pipe:
+            pipe.set(name, compressed, expiry, nx=(not override))
+            pipe.hincrby('storage:compression', f'{prefix}:raw', len(content))
+            pipe.hincrby('storage:compression', f'{prefix}:stored', len(compressed))
+            return pipe.execute()[0]
+
+    def compression_stats(self) -> Dict[str, dict]:
+        """Get the amount of bytes written to the cache per key prefix, before & after compression"""
+        counters = self.cache.hgetall('storage:compression')
+        stats = {}
+
+        for field, value in counters.items():
+            prefix, kind = field.decode().rsplit(':', 1)
+            stats.setdefault(prefix, {'raw': 0, 'stored': 0})[kind] = int(value)
+
+        for prefix in stats.values():
+            prefix['saved'] = prefix['raw'] - prefix['stored']
+            prefix['ratio'] = prefix['stored'] / prefix['raw'] if prefix['raw'] else 1.0
+
+        return stats
+
+    def remove_from_cache(self, name: str) -> bool:
+        self.invalidate_local(name)
+        return self.cache.delete(name) > 0
+
+    def invalidate(self, *names: str) -> None:
+        """Invalidate missing markers & local copies of objects, after they were overwritten"""
+        self.cache.delete(*(f'missing:{name}' for name in names))
+        self.invalidate_local(*names)
+
+    def evict(self, bucket: str, *keys: str) -> None:
+        """Remove cached copies & missing markers of objects in a bucket, after they were overwritten or removed"""
+        names = [
+            name
+            for key in keys
+            for name in CACHE_NAMES.get(bucket, lambda key: ())(key)
+        ]
+
+        if not names:
+            return
+
+        self.cache.delete(*names, *(f'missing:{name}' for name in names))
+        self.invalidate_local(*names)
+
+    def invalidate_local(self, *names: str) -> None:
+        """Remove local copies of objects in every process, including ones without a local cache"""
+        with self.cache.pipeline(transaction=False) as pipe:
+            for name in names:
+                if self.local:
+                    self.local.remove(name)
+
+                pipe.publish('storage:invalidate', name)
+
+            pipe.execute()
+
+    def on_invalidate(self, message: dict) -> None:
+        self.local.remove(message['data'].decode())
+
+    def save_to_file(self, filepath: str, content: Content) -> bool:
+        hash = hashlib.md5()
 
-    def save_to_file(self, filepath: str, content: bytes) -> bool:
         try:
             with open(f'{config.DATA_PATH}/{filepath}', 'wb') as f:
-                f.write(content)
+                for chunk in iter_parts(content, 1024 * 1024):
+                    f.write(chunk)
+                    hash.update(chunk)
         except Exception as e:
             self.logger.error(f'Failed to save file "{filepath}": {e}')
             return False
 
+        directory, filename = os.path.split(filepath)
+        self.index_file_hash(
+            directory.strip('/'),
+            filename,
+            hash.hexdigest(),
+            self.file_signature(f'{config.DATA_PATH}/{filepath}')
+        )
         return True
 
-    def save_to_s3(self, content: bytes, key: str, bucket: str) -> bool:
+    def save_to_s3(self, content: Content, key: str, bucket: str) -> bool:
+        """Upload bytes, a file-like object or an iterator of chunks to s3.
+
+        Content that is larger than `part_size` is streamed as a multipart upload,
+        without reading all of it into memory.
+        """
+        parts = iter_parts(content, self.part_size)
+        start = time.perf_counter()
+
         try:
-            self.s3.upload_fileobj(
-                io.BytesIO(content),
-                bucket,
-                key
-            )
+            first = next(parts, b'')
+            second = next(parts, None)
+
+            if second is None:
+                response = self.s3.put_object(
+                    Bucket=bucket,
+                    Key=key,
+                    Body=bytes(first)
+                )
+                size, etag = len(first), response['ETag']
+            else:
+                size, etag = self.upload_multipart(
+                    itertools.chain((first, second), parts),
+                    key, bucket
+                )
         except Exception as e:
             self.logger.error(f'Failed to upload "{key}" to s3: "{e}"')
             return False
 
+        self.index_file_hash(bucket, key, etag.replace('"', ''))
+
+        elapsed = time.perf_counter() - start
+        self.logger.debug(
+            f'Uploaded "{key}" to {bucket} '
+            f'({size / 1024:.1f} KB in {elapsed:.2f}s, '
+            f'{size / 1024 / 1024 / max(elapsed, 1e-6):.2f} MB/s)'
+        )
         return True
 
+    def upload_multipart(self, parts: Iterator[bytes], key: str, bucket: str) -> Tuple[int, str]:
+        """Upload parts concurrently, with at most `upload_concurrency` parts held in memory
+
+        `returns`: The size & etag of the uploaded object
+        """
+        upload_id = self.s3.create_multipart_upload(Bucket=bucket, Key=key)['UploadId']
+        futures: Dict[int, Future] = {}
+        completed: List[dict] = []
+        size = 0
+
+        try:
+            with ThreadPoolExecutor(self.upload_concurrency) as pool:
+                for number, part in enumerate(parts, start=1):
+                    if len(futures) >= self.upload_concurrency:
+                        oldest = min(futures)
+                        completed.append(futures.pop(oldest).result())
+
+                    futures[number] = pool.submit(
+                        self.upload_part,
+                        bytes(part), number,
+                        upload_id, key, bucket
+                    )
+                    size += len(part)
+
+                completed.extend(
+                    futures[number].result()
+                    for number in sorted(futures)
+                )
+
+            response = self.s3.complete_multipart_upload(
+                Bucket=bucket,
+                Key=key,
+                UploadId=upload_id,
+                MultipartUpload={'Parts': completed}
+            )
+        except Exception:
+            self.s3.abort_multipart_upload(
+                Bucket=bucket,
+                Key=key,
+                UploadId=upload_id
+            )
+            raise
+
+        return size, response['ETag']
+
+    def upload_part(self, data: bytes, number: int, upload_id: str, key: str, bucket: str) -> dict:
+        """Upload a single part, and retry it on failure instead of restarting the upload"""
+        for attempt in range(self.part_retries + 1):
+            try:
+                response = self.s3.upload_part(
+                    Bucket=bucket,
+                    Key=key,
+                    UploadId=upload_id,
+                    PartNumber=number,
+                    Body=data
+                )
+                return {'PartNumber': number, 'ETag': response['ETag']}
+            except Exception as e:
+                if attempt >= self.part_retries:
+                    raise
+
+                self.logger.warning(
+                    f'Failed to upload part {number} of "{key}" ({e}), retrying...'
+                )
+                time.sleep(2 ** attempt)
+
     def remove_from_s3(self, bucket: str, key: str) -> bool:
         try:
             self.s3.delete_object(
@@ -463,18 +1139,52 @@ class Storage:
             self.logger.error(f'Failed to remove "{key}" from {bucket}: "{e}"')
             return False
 
+        self.unindex_file_hashes(bucket, key)
         return True
 
     def get_from_cache(self, name: str) -> bytes | None:
-        return self.cache.get(name)
+        if self.local and (content := self.local.get(name)):
+            return content
+
+        if not (content := self.cache.get(name)):
+            return
 
-    def get_file_content(self, filepath: str) -> bytes | None:
+        content = compression.decompress(content)
+
+        if self.local:
+            self.local.set(name, content)
+
+        return content
+
+    def get_file_content(self, filepath: str, missing_ok: bool = True) -> bytes | None:
         try:
             with open(f'{config.DATA_PATH}/{filepath}', 'rb') as f:
                 return f.read()
+        except FileNotFoundError:
+            if not missing_ok:
+                raise
         except Exception as e:
             self.logger.error(f'Failed to read file "{filepath}": {e}')
 
+    def open_file(self, filepath: str, start: int = 0, end: int | None = None) -> StoredObject | None:
+        try:
+            file = open(f'{config.DATA_PATH}/{filepath}', 'rb')
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            self.logger.error(f'Failed to open file "{filepath}": {e}')
+            return
+
+        total_size = os.fstat(file.fileno()).st_size
+        end = total_size - 1 if end is None else min(end, total_size - 1)
+
+        if start > end and total_size:
+            file.close()
+            return
+
+        file.seek(start)
+        return StoredObject(file, start, end, total_size)
+
     def remove_file(self, filepath: str) -> bool:
         try:
             os.remove(f'{config.DATA_PATH}/{filepath}')
@@ -482,9 +1192,11 @@ class Storage:
             self.logger.error(f'Failed to file "{filepath}": "{e}"')
             return False
 
+        directory, filename = os.path.split(filepath)
+        self.unindex_file_hashes(directory.strip('/'), filename)
         return True
 
-    def get_from_s3(self, key: str, bucket: str) -> bytes | None:
+    def get_from_s3(self, key: str, bucket: str, missing_ok: bool = True) -> bytes | None:
         buffer = io.BytesIO()
 
         try:
@@ -493,8 +1205,13 @@ class Storage:
                 key,
                 buffer
             )
-        except ClientError:
-            # Most likely not found
+        except ClientError as e:
+            if not is_not_found(e):
+                self.logger.error(f'Failed to download "{key}" from s3: "{e}"')
+                return
+
+            if not missing_ok:
+                raise FileNotFoundError(f'{bucket}/{key}') from e
             return
         except Exception as e:
             self.logger.error(f'Failed to download "{key}" from s3: "{e}"')
@@ -502,6 +1219,36 @@ class Storage:
 
         return buffer.getvalue()
 
+    def open_from_s3(self, key: str, bucket: str, start: int = 0, end: int | None = None) -> StoredObject | None:
+        arguments = {'Bucket': bucket, 'Key': key}
+
+        if start > 0 or end is not None:
+            arguments['Range'] = f'bytes={start}-{"" if end is None else end}'
+
+        try:
+            response = self.s3.get_object(**arguments)
+        except ClientError:
+            # Most likely not found, or an invalid range
+            return
+        except Exception as e:
+            self.logger.error(f'Failed to open "{key}" from s3: "{e}"')
+            return
+
+        if not (content_range := response.get('ContentRange')):
+            size = response['ContentLength']
+            return StoredObject(response['Body'], 0, size - 1, size)
+
+        # e.g. "bytes 0-1023/4096"
+        bounds, total_size = content_range.split(' ')[-1].split('/')
+        start, end = bounds.split('-')
+
+        return StoredObject(
+            response['Body'],
+            int(start),
+            int(end),
+            int(total_size)
+        )
+
     def file_exists(self, key: str, bucket: str) -> bool:
         if not config.S3_ENABLED:
             return os.path.isfile(f'{config.DATA_PATH}/{bucket}/{key}')
@@ -1,11 +1,34 @@
 
-from typing	import List
+from typing	import Dict, List
+from functools import lru_cache
 from enum import Enum
 import struct
 
+FORMATS = {
+	"u16": "H",
+	"u32": "I",
+	"u64": "Q",
+	"s8": "b",
+	"s16": "h",
+	"s32": "i",
+	"s64": "q",
+	"float": "f",
+	"double": "d",
+	"header": "HxI",
+	"legacy_header": "HI"
+}
+
+@lru_cache(maxsize=None)
+def compile_formats(endian: str) -> Dict[str, struct.Struct]:
+	return {
+		name: struct.Struct(endian + format)
+		for name, format in FORMATS.items()
+	}
+
 class StreamOut:
 	def __init__(self, endian="<"):
 		self.endian = endian
+		self.structs = compile_formats(endian)
 		self.data = bytearray()
 		self.pos = 0
 		self.stack = []
@@ -14,6 +37,14 @@ class StreamOut:
 	def pop(self): self.pos = self.stack.pop()
 
 	def get(self): return bytes(self.data)
+	def view(self):
+		"""Get the written data without copying it.
+
+		The view has to be released before writing to the stream again,
+		since the bytearray can't be resized while it is exported.
+		"""
+		return memoryview(self.data)
+
 	def size(self): return len(self.data)
 	def tell(self): return self.pos
 	def seek(self, pos):
@@ -25,7 +56,7 @@ class StreamOut:
 	def align(self, num): self.skip((num - self.pos % num) % num)
 	def available(self): return len(self.data) - self.pos
 	def eof(self): return self.pos >= len(self.data)
-		
+
 	def write(self, data):
 		self.data[self.pos : self.pos + len(data)] = data
 		self.pos += len(data)
@@ -34,21 +65,37 @@ class StreamOut:
 		self.data[0 : 0] = data
 		self.pos += len(data)
 
+	def pack(self, format: struct.Struct, *values):
+		if self.pos == len(self.data):
+			# Appending is the common case, which bytearray handles with amortized growth
+			self.data += format.pack(*values)
+		else:
+			end = self.pos + format.size
+			if end > len(self.data): self.data += bytes(end - len(self.data))
+			format.pack_into(self.data, self.pos, *values)
+		self.pos += format.size
+
 	def pad(self, num, char=b"\0"):
 		self.write(char * num)
 
 	def ascii(self, data):
 		self.write(data.encode("ascii"))
 
-	def u8(self, value): self.write(bytes([value]))
-	def u16(self, value): self.write(struct.pack(self.endian + "H", value))
-	def u32(self, value): self.write(struct.pack(self.endian + "I", value))
-	def u64(self, value): self.write(struct.pack(self.endian + "Q", value))
+	def u8(self, value):
+		if self.pos == len(self.data):
+			self.data.append(value)
+			self.pos += 1
+		else:
+			self.write(bytes([value]))
+
+	def u16(self, value): self.pack(self.structs["u16"], value)
+	def u32(self, value): self.pack(self.structs["u32"], value)
+	def u64(self, value): self.pack(self.structs["u64"], value)
 
-	def s8(self, value): self.write(struct.pack("b", value))
-	def s16(self, value): self.write(struct.pack(self.endian + "h", value))
-	def s32(self, value): self.write(struct.pack(self.endian + "i", value))
-	def s64(self, value): self.write(struct.pack(self.endian + "q", value))
+	def s8(self, value): self.pack(self.structs["s8"], value)
+	def s16(self, value): self.pack(self.structs["s16"], value)
+	def s32(self, value): self.pack(self.structs["s32"], value)
+	def s64(self, value): self.pack(self.structs["s64"], value)
 
 	def u24(self, value):
 		if self.endian == ">":
@@ -58,26 +105,26 @@ class StreamOut:
 			self.u8(value & 0xFF)
 			self.u16(value >> 8)
 
-	def float(self, value): self.write(struct.pack(self.endian + "f", value))
-	def double(self, value): self.write(struct.pack(self.endian + "d", value))
+	def float(self, value): self.pack(self.structs["float"], value)
+	def double(self, value): self.pack(self.structs["double"], value)
 
 	def bool(self, value): self.u8(1 if value else 0)
 	def char(self, value): self.u8(ord(value))
 	def wchar(self, value): self.u16(ord(value))
 
 	def header(self, packet: Enum, size: int):
-		self.write(struct.pack(self.endian + 'HxI', packet.value, size))
+		self.pack(self.structs["header"], packet.value, size)
 
 	def legacy_header(self, packet: Enum, size: int):
-		self.write(struct.pack(self.endian + 'HI', packet.value, size))
+		self.pack(self.structs["legacy_header"], packet.value, size)
 
 	def intlist(self, numbers: List[int]):
-		self.s16(len(numbers))
-		[self.s32(num) for num in numbers]
+		self.write(struct.pack(f"{self.endian}h{len(numbers)}i", len(numbers), *numbers))
 
 	def uleb128(self, value):
 		if value == 0:
-			return b'\x00'
+			self.u8(0)
+			return
 
 		ret = bytearray()
 
@@ -87,7 +134,7 @@ class StreamOut:
 			if value != 0:
 				ret[-1] |= 0x80
 
-		self.write(bytes(ret))
+		self.write(ret)
 
 	def string(self, value: str):
 		if not value:
@@ -102,9 +149,10 @@ class StreamOut:
 		self.write(string)
 
 class StreamIn:
-	def __init__(self, data: bytes, endian="<"):
+	def __init__(self, data: bytes, endian="<", zero_copy=False):
 		self.endian = endian
-		self.data = data
+		self.data = memoryview(data).cast("B") if zero_copy else data
+		self.structs = compile_formats(endian)
 		self.pos = 0
 		self.stack = []
 
@@ -132,36 +180,48 @@ class StreamIn:
 
 	def read(self, num):
 		data = self.peek(num)
-		self.skip(num)
+		self.pos += num
 		return data
 
 	def readall(self):
 		return self.read(self.available())
 
+	def unpack(self, format: struct.Struct):
+		if self.pos + format.size > len(self.data):
+			raise OverflowError("Buffer overflow")
+		value = format.unpack_from(self.data, self.pos)[0]
+		self.pos += format.size
+		return value
+
 	def pad(self, num, char=b"\0"):
 		if (self.read(num)) != char * num:
 			raise ValueError("Incorrect padding")
 
 	def ascii(self, num):
-		return self.read(num).decode("ascii")
-
-	def u8(self): return self.read(1)[0]
-	def u16(self): return struct.unpack(self.endian + "H", self.read(2))[0]
-	def u32(self): return struct.unpack(self.endian + "I", self.read(4))[0]
-	def u64(self): return struct.unpack(self.endian + "Q", self.read(8))[0]
-	
-	def s8(self): return struct.unpack("b", self.read(1))[0]
-	def s16(self): return struct.unpack(self.endian + "h", self.read(2))[0]
-	def s32(self): return struct.unpack(self.endian + "i", self.read(4))[0]
-	def s64(self): return struct.unpack(self.endian + "q", self.read(8))[0]
+		return str(self.read(num), "ascii")
+
+	def u8(self):
+		if self.pos >= len(self.data):
+			raise OverflowError("Buffer overflow")
+		self.pos += 1
+		return self.data[self.pos - 1]
+
+	def u16(self): return self.unpack(self.structs["u16"])
+	def u32(self): return self.unpack(self.structs["u32"])
+	def u64(self): return self.unpack(self.structs["u64"])
+
+	def s8(self): return self.unpack(self.structs["s8"])
+	def s16(self): return self.unpack(self.structs["s16"])
+	def s32(self): return self.unpack(self.structs["s32"])
+	def s64(self): return self.unpack(self.structs["s64"])
 
 	def u24(self):
 		if self.endian == ">":
 			return (self.u16() << 8) | self.u8()
 		return self.u8() | (self.u16() << 8)
 
-	def float(self): return struct.unpack(self.endian + "f", self.read(4))[0]
-	def double(self): return struct.unpack(self.endian + "d", self.read(8))[0]
+	def float(self): return self.unpack(self.structs["float"])
+	def double(self): return self.unpack(self.structs["double"])
 
 	def bool(self): return bool(self.u8())
 	def char(self): return chr(self.u8())
@@ -188,7 +248,7 @@ class StreamIn:
 			return ""
 		
 		size = self.uleb128()
-		return self.read(size).decode()
+		return str(self.read(size), "utf-8")
 
 	def intlist(self):
 		return [self.s32() for num in range(self.s16())]